@@ -1,16 +1,45 @@
 import cProfile
 import os
+import random
+from multiprocessing.pool import Pool
 from pickle import Pickler
 
+import numpy as np
 from pytorch_classification.utils import Bar, AverageMeter
 import time
 
+# the arena of a worker process and its players in the original order, see Arena.parallel_results
+_worker_arena = None
+_worker_players = None
+
+
+def _init_arena_worker(arena):
+    global _worker_arena, _worker_players
+    _worker_arena = arena
+    _worker_players = (arena.player1, arena.player2)
+
+
+def _play_worker_game(game):
+    game_id, seed, swapped = game
+    # the seed of a game doesn't depend on the worker it is scheduled on
+    random.seed(seed)
+    np.random.seed(seed)
+    arena = _worker_arena
+    arena.player1, arena.player2 = _worker_players[::-1] if swapped else _worker_players
+    arena.game_id = game_id
+    if arena.reset_players is not None:
+        arena.reset_players()
+    gameResult = None
+    while gameResult is None:
+        gameResult = arena.playGame()
+    return swapped, gameResult
+
 
 class Arena():
     """
     An Arena class where any 2 agents can be pit against each other.
     """
-    def __init__(self, player1, player2, game, display=None, replay=False):
+    def __init__(self, player1, player2, game, display=None, replay=False, reset_players=None):
         """
         Input:
             player 1,2: two functions that takes board as input, return action
@@ -18,6 +47,11 @@ class Arena():
             display: a function that takes board as input and prints it (e.g.
                      display in othello/OthelloGame). Is necessary for verbose
                      mode.
+            reset_players: a function that resets the state of the players
+                           (e.g. their search trees). Is called before every
+                           game of a worker process in parallel mode, so that
+                           the results don't depend on the order in which the
+                           games are scheduled.
 
         see othello/OthelloPlayers.py for an example. See pit.py for pitting
         human players/other baselines with each other.
@@ -27,6 +61,7 @@ class Arena():
         self.game = game
         self.display = display
         self.replay = replay
+        self.reset_players = reset_players
         self.game_id = 0
 
     def playGame(self, verbose=False):
@@ -81,10 +116,11 @@ class Arena():
             self.game_id += 1
         return self.game.getGameEnded(board, 1)
 
-    def playGames(self, num, profile, verbose=False):
+    def playGames(self, num, profile, verbose=False, num_workers=1):
         """
         Plays num games in which player1 starts num/2 games and player2 starts
-        num/2 games.
+        num/2 games. With num_workers > 1 the games are played in a pool of
+        worker processes, each with its own copy of the players.
 
         Returns:
             oneWon: games won by player1
@@ -112,40 +148,31 @@ class Arena():
         if profile:
             prof = cProfile.Profile()
             prof.enable()
-        for _ in range(num):
-            gameResult = None
-            while gameResult is None:
-                gameResult = self.playGame(verbose=verbose)
-            if gameResult==1:
-                oneWon+=1
-                oneBlackWon+=1
-            elif gameResult==-1:
-                twoWon+=1
-                twoWhiteWon+=1
-            else:
-                draws+=1
-            # bookkeeping + plot progress
-            eps += 1
-            eps_time.update(time.time() - end)
-            end = time.time()
-            bar.suffix  = '({eps}/{maxeps}) Eps Time: {et:.3f}s | Total: {total:} | ETA: {eta:}'.format(eps=eps, maxeps=maxeps, et=eps_time.avg,
-                                                                                                       total=bar.elapsed_td, eta=bar.eta_td)
-            bar.next()
 
-        self.player1, self.player2 = self.player2, self.player1
-        
-        for _ in range(num):
-            gameResult = None
-            while gameResult is None:
-                gameResult = self.playGame(verbose=verbose)
-            if gameResult==-1:
-                oneWon+=1
-                oneWhiteWon+=1
-            elif gameResult==1:
-                twoWon+=1
-                twoBlackWon+=1
+        if num_workers > 1:
+            results = self.parallel_results(num, num_workers)
+        else:
+            results = self.sequential_results(num, verbose)
+
+        for swapped, gameResult in results:
+            if not swapped:
+                if gameResult==1:
+                    oneWon+=1
+                    oneBlackWon+=1
+                elif gameResult==-1:
+                    twoWon+=1
+                    twoWhiteWon+=1
+                else:
+                    draws+=1
             else:
-                draws+=1
+                if gameResult==-1:
+                    oneWon+=1
+                    oneWhiteWon+=1
+                elif gameResult==1:
+                    twoWon+=1
+                    twoBlackWon+=1
+                else:
+                    draws+=1
             # bookkeeping + plot progress
             eps += 1
             eps_time.update(time.time() - end)
@@ -160,3 +187,45 @@ class Arena():
             prof.print_stats(sort=2)
 
         return oneWon, twoWon, draws, oneWhiteWon, oneBlackWon, twoWhiteWon, twoBlackWon
+
+    def sequential_results(self, num, verbose):
+        """
+        Plays num games with player1 starting, then swaps the players and
+        plays num more games.
+
+        Returns:
+            results: a generator of (swapped, gameResult) for every game
+        """
+        for _ in range(num):
+            gameResult = None
+            while gameResult is None:
+                gameResult = self.playGame(verbose=verbose)
+            yield False, gameResult
+
+        self.player1, self.player2 = self.player2, self.player1
+
+        for _ in range(num):
+            gameResult = None
+            while gameResult is None:
+                gameResult = self.playGame(verbose=verbose)
+            yield True, gameResult
+
+    def parallel_results(self, num, num_workers):
+        """
+        Plays the same 2*num games as sequential_results in num_workers
+        processes. Every game has a fixed id (used for its replay file) and
+        seed, so it is played the same way no matter which worker gets it.
+
+        Returns:
+            results: a generator of (swapped, gameResult) for every game in
+                     the order the games are finished
+        """
+        seeds = np.random.randint(2**31, size=2 * num).tolist()
+        games = [(self.game_id + i, seeds[i], i >= num) for i in range(2 * num)]
+        # NB! CUDA can't be used in forked processes, the players must only use networks on the cpu (see Coach.learn)
+        with Pool(num_workers, initializer=_init_arena_worker, initargs=(self,)) as pool:
+            yield from pool.imap_unordered(_play_worker_game, games)
+
+        # same state as after sequential_results
+        self.player1, self.player2 = self.player2, self.player1
+        self.game_id += 2 * num
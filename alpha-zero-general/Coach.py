@@ -2,36 +2,88 @@ import cProfile
 import copy
 import math
 from collections import deque
-from multiprocessing.pool import Pool
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 from Arena import Arena
+from EvaluationCache import EvaluationCache
+from InferenceServer import InferenceServer
 from MCTS import MCTS
+from PrioritizedReplay import PrioritizedSampler
+from ReplayBuffer import HistorySampler, ReplayBuffer
 import numpy as np
 from pytorch_classification.utils import Bar, AverageMeter
 import time, os, sys
-from pickle import Pickler, Unpickler
-from random import shuffle
+import random
 
+from tafl.SymmetryTables import get_symmetry_tables
 from tafl.TaflBoard import Player
 from trainingData import read_data
 
+# the coach of a self-play worker process, see Coach.parallel_episodes
+_worker_coach = None
+
+
+def _init_self_play_worker(game, white_nnet, black_nnet, args, inference_server=None):
+    global _worker_coach
+    if inference_server is not None:
+        # the networks stay in the server process
+        white_nnet, black_nnet = inference_server.connect()
+    _worker_coach = Coach(game, white_nnet, black_nnet, args, create_competitors=False)
+
+
+def _cpu_copy(nnet):
+    # NB! CUDA can't be used in forked processes, the workers get copies of the networks on the cpu. Networks without
+    # cpu_copy are passed as they are
+    return nnet.cpu_copy() if hasattr(nnet, 'cpu_copy') else nnet
+
+
+def _execute_worker_episode(seed):
+    # every episode gets its own seed, otherwise the forked workers would play the same games
+    random.seed(seed)
+    np.random.seed(seed)
+    _worker_coach.mcts = MCTS(_worker_coach.game, _worker_coach.white_nnet, _worker_coach.black_nnet,
+                              _worker_coach.args, _worker_coach.cache)   # reset search tree
+    return _worker_coach.executeEpisode()
+
 
 class Coach():
     """
     This class executes the self-play + learning. It uses the functions defined
     in Game and NeuralNet. args are specified in main.py.
     """
-    def __init__(self, game, white_nnet, black_nnet, args):
+    def __init__(self, game, white_nnet, black_nnet, args, create_competitors=True):
         self.game = game
         self.white_nnet = white_nnet
         self.black_nnet = black_nnet
-        self.white_pnet = self.white_nnet.__class__(self.game)  # the competitor network
-        self.black_pnet = self.black_nnet.__class__(self.game)
+        if create_competitors:
+            self.white_pnet = self.white_nnet.__class__(self.game)  # the competitor network
+            self.black_pnet = self.black_nnet.__class__(self.game)
         self.args = args
-        self.mcts = MCTS(self.game, self.white_nnet, self.black_nnet, self.args)
+        # network evaluations kept across episodes, outdated when the weights change
+        self.cache = EvaluationCache(self.args.evaluation_cache_mb) if self.args.evaluation_cache_mb > 0 else None
+        self.mcts = MCTS(self.game, self.white_nnet, self.black_nnet, self.args, self.cache)
         # self.trainExamplesHistory = []  ###########
-        self.trainExamplesHistory_white = []    # history of examples from args.numItersForTrainExamplesHistory latest iterations
-        self.trainExamplesHistory_black = []    # history of examples from args.numItersForTrainExamplesHistory latest iterations
+        # history of examples from args.numItersForTrainExamplesHistory latest iterations, one segment per iteration
+        self.trainExamplesHistory_white = self.create_replay_buffer('white')
+        self.trainExamplesHistory_black = self.create_replay_buffer('black')
+        # the samplers live as long as the buffers, so that the priorities of a prioritized sampler are kept
+        self.sampler_white = self.create_sampler(self.trainExamplesHistory_white)
+        self.sampler_black = self.create_sampler(self.trainExamplesHistory_black)
+
+    def create_replay_buffer(self, name):
+        # the history is kept as one shard per iteration in the checkpoint folder, see ReplayBuffer.py
+        folder = os.path.join(self.args.checkpoint, 'training_' + name + '_examples')
+        # without the stored symmetries, the buffer applies a random one to every example it samples
+        symmetry_tables = None if self.args.store_symmetries else get_symmetry_tables(self.game.size)
+        return ReplayBuffer(self.game.getBoardSize(), self.game.getActionSize(), folder=folder,
+                            symmetry_tables=symmetry_tables, aggregate=self.args.aggregate_positions)
+
+    def create_sampler(self, buffer):
+        if self.args.prioritized_replay:
+            return PrioritizedSampler(buffer, self.args.priority_alpha, self.args.priority_beta,
+                                      recency_decay=self.args.history_recency_decay,
+                                      count_exponent=self.args.aggregate_count_exponent)
+        return HistorySampler(buffer, self.args.history_recency_decay, self.args.aggregate_count_exponent)
 
     def executeEpisode(self):
         """
@@ -45,9 +97,13 @@ class Coach():
         uses temp=0.
 
         Returns:
-            trainExamples: a list of examples of the form (canonicalBoard,pi,v)
-                           pi is the MCTS informed policy vector, v is +1 if
-                           the player eventually won the game, else -1.
+            trainExamples: a list of examples of the form
+                           (canonicalBoard,pi,v,king_position,visits)
+                           pi is the MCTS informed policy as a sparse
+                           (indices, probs) pair, v is +1 if the player
+                           eventually won the game, else -1. visits is the
+                           number of root visits behind pi, which weights
+                           pi when positions are aggregated.
         """
         trainExamples_white = []
         trainExamples_black = []
@@ -63,17 +119,19 @@ class Coach():
             temp = int(episodeStep < self.args.tempThreshold)
 
             try:
-                pi = self.mcts.getActionProb(canonicalBoard, self.curPlayer, temp=temp)
+                # (indices, probs) of the visited actions, the policy is only densified in the training batches
+                pi = self.mcts.getActionProb(canonicalBoard, self.curPlayer, temp=temp, sparse=True)
             except ZeroDivisionError:
                 print("ZeroDivisionError while building training example. continue with next iteration")
                 return [], []
-            sym = self.game.getSymmetries(canonicalBoard, pi, canonicalBoard.king_position)
-
+            # the symmetries are added for all moves at once when the episode is over (or when the examples are
+            # sampled for training, see args.store_symmetries)
             player_train_examples = trainExamples_white if self.curPlayer == Player.white else trainExamples_black
-            for b,p, scalar_values in sym:
-                player_train_examples.append([b, self.curPlayer, p, scalar_values])
+            player_train_examples.append([canonicalBoard.board[1:self.game.size + 1, 1:self.game.size + 1].copy(),
+                                          self.curPlayer, pi, canonicalBoard.king_position,
+                                          self.mcts.root_visits(canonicalBoard, self.curPlayer)])
 
-            action = np.random.choice(len(pi), p=pi)
+            action = np.random.choice(pi[0], p=pi[1])
             if action == 0:
                 print(pi)
 
@@ -86,8 +144,34 @@ class Coach():
             if r!=0:
                 # if board.outcome == Outcome.black:
                 #     print(" black wins")
-                return [(x[0],x[2],r*((-1)**(x[1]!=self.curPlayer)), x[3]) for x in trainExamples_white], \
-                       [(x[0],x[2],r*((-1)**(x[1]!=self.curPlayer)), x[3]) for x in trainExamples_black]
+                return [(x[0],x[2],r*((-1)**(x[1]!=self.curPlayer)), x[3], x[4])
+                        for x in self.symmetric_examples(trainExamples_white)], \
+                       [(x[0],x[2],r*((-1)**(x[1]!=self.curPlayer)), x[3], x[4])
+                        for x in self.symmetric_examples(trainExamples_black)]
+
+    def symmetric_examples(self, examples):
+        """
+        Input:
+            examples: list of [board, player, pi, king_position, visits] of one
+                      player (pi sparse)
+
+        Returns:
+            symmetricExamples: list of [board, player, pi, king_position,
+                               visits] with all symmetrical forms (see
+                               TaflGame.getSymmetries) of every example,
+                               or the examples themselves if the replay
+                               buffers apply the symmetries
+        """
+        if not self.args.store_symmetries:
+            return examples
+        if not examples:
+            return []
+        boards, players, pis, king_positions, visits = zip(*examples)
+        boards, pis, king_positions = self.game.getSparseSymmetriesBatch(np.array(boards), pis,
+                                                                         np.array(king_positions))
+        number_of_symmetries = len(boards) // len(examples)
+        return [[boards[i], players[i // number_of_symmetries], pis[i], tuple(king_positions[i].tolist()),
+                 visits[i // number_of_symmetries]] for i in range(len(boards))]
 
     def learn(self):
         """
@@ -117,11 +201,13 @@ class Coach():
                     prof = cProfile.Profile()
                     prof.enable()
 
-                for eps in range(self.args.numEps):
-                    self.mcts = MCTS(self.game, self.white_nnet, self.black_nnet, self.args)   # reset search tree
-
-                    white_examples, black_examples = self.executeEpisode()
+                if self.args.numSelfPlayWorkers > 1:
+                    episodes = self.parallel_episodes()
+                else:
+                    episodes = self.sequential_episodes()
 
+                # the examples are added as soon as an episode is finished
+                for eps, (white_examples, black_examples) in enumerate(episodes):
                     iterationTrainExamples_white += white_examples
                     iterationTrainExamples_black += black_examples
 
@@ -132,18 +218,21 @@ class Coach():
                                                                                                                total=bar.elapsed_td, eta=bar.eta_td)
                     bar.next()
                 bar.finish()
+                if self.cache is not None and self.args.numSelfPlayWorkers <= 1:
+                    print('evaluation cache: ' + str(self.cache))
                 if self.args.profile_coach:
                     prof.disable()
                     prof.print_stats(sort=2)
 
                 # save the iteration examples to the history 
-                self.trainExamplesHistory_white.append(iterationTrainExamples_white)
-                self.trainExamplesHistory_black.append(iterationTrainExamples_black)
+                self.trainExamplesHistory_white.add_iteration(i, iterationTrainExamples_white)
+                self.trainExamplesHistory_black.add_iteration(i, iterationTrainExamples_black)
                 
-            while len(self.trainExamplesHistory_white) > self.args.numItersForTrainExamplesHistory:
-                print("len(trainExamplesHistory) =", len(self.trainExamplesHistory_white), " => remove the oldest trainExamples")
-                self.trainExamplesHistory_white.pop(0)
-                self.trainExamplesHistory_black.pop(0)
+            while self.trainExamplesHistory_white.num_iterations() > self.args.numItersForTrainExamplesHistory:
+                print("len(trainExamplesHistory) =", self.trainExamplesHistory_white.num_iterations(),
+                      " => remove the oldest trainExamples")
+                self.trainExamplesHistory_white.pop_oldest()
+                self.trainExamplesHistory_black.pop_oldest()
             # backup history to a file
             # NB! the examples were collected using the model from the previous iteration, so (i-1)  
             self.saveTrainExamples(i-1)
@@ -154,46 +243,30 @@ class Coach():
             self.white_pnet.load_checkpoint(folder=self.args.checkpoint, filename='temp_white.pth.tar')
             self.black_pnet.load_checkpoint(folder=self.args.checkpoint, filename='temp_black.pth.tar')
 
-            pmcts = MCTS(self.game, self.white_pnet, self.black_pnet, self.args)
+            pmcts = MCTS(self.game, self.white_pnet, self.black_pnet, self.args, self.cache)
 
+            # the networks draw their batches directly from the replay buffers by the global example index
             if not self.args.train_both:
                 if train_black:
-                    # shuffle examples before training
-                    trainExamples = []
-                    for e in self.trainExamplesHistory_black:
-                        trainExamples.extend(e)
-                    shuffle(trainExamples)
-                    self.black_nnet.train(trainExamples)
+                    self.black_nnet.train(self.sampler_black)
                 else:
-                    # shuffle examples before training
-                    trainExamples = []
-                    for e in self.trainExamplesHistory_white:
-                        trainExamples.extend(e)
-                    shuffle(trainExamples)
-                    self.white_nnet.train(trainExamples)
+                    self.white_nnet.train(self.sampler_white)
             else:
-                # shuffle examples before training
-                trainExamples = []
-                for e in self.trainExamplesHistory_black:
-                    trainExamples.extend(e)
-                shuffle(trainExamples)
-                self.black_nnet.train(trainExamples)
-
-                # shuffle examples before training
-                trainExamples = []
-                for e in self.trainExamplesHistory_white:
-                    trainExamples.extend(e)
-                shuffle(trainExamples)
-                self.white_nnet.train(trainExamples)
-
-            nmcts = MCTS(self.game, self.white_nnet, self.black_nnet, self.args)
+                self.black_nnet.train(self.sampler_black)
+                self.white_nnet.train(self.sampler_white)
+
+            nmcts = MCTS(self.game, self.white_nnet, self.black_nnet, self.args, self.cache)
 
             print('PITTING AGAINST PREVIOUS VERSION')
+            if self.args.numArenaWorkers > 1:
+                # the arena workers are forked, so the players search with copies of the networks on the cpu
+                pmcts = MCTS(self.game, _cpu_copy(self.white_pnet), _cpu_copy(self.black_pnet), self.args, self.cache)
+                nmcts = MCTS(self.game, _cpu_copy(self.white_nnet), _cpu_copy(self.black_nnet), self.args, self.cache)
             arena = Arena(lambda board, turn_player: np.argmax(pmcts.getActionProb(board, turn_player, temp=0)),
                           lambda board, turn_player: np.argmax(nmcts.getActionProb(board, turn_player, temp=0)),
-                          self.game)
+                          self.game, reset_players=lambda: (pmcts.reset(), nmcts.reset()))
             pwins, nwins, draws, pwins_white, pwins_black, nwins_white, nwins_black \
-                = arena.playGames(self.args.arenaCompare, self.args.profile_arena)
+                = arena.playGames(self.args.arenaCompare, self.args.profile_arena, num_workers=self.args.numArenaWorkers)
 
             print('NEW/PREV WINS (white, black) : (%d,%d) / (%d,%d) ; DRAWS : %d' % (nwins_white, nwins_black, pwins_white, pwins_black, draws))
 
@@ -235,24 +308,68 @@ class Coach():
             print("prune probability: " + str(self.game.prune_prob) + ", episodes: " + str(self.args.numEps) +
                   ", sims: " + str(self.args.numMCTSSims) + ", arena compare: " + str(self.args.arenaCompare))
 
+    def sequential_episodes(self):
+        """
+        Plays numEps episodes of self-play one after another.
+
+        Returns:
+            episodes: a generator of the (white, black) examples of every episode
+        """
+        for _ in range(self.args.numEps):
+            self.mcts = MCTS(self.game, self.white_nnet, self.black_nnet, self.args, self.cache)   # reset search tree
+            yield self.executeEpisode()
+
+    def parallel_episodes(self):
+        """
+        Plays numEps episodes of self-play in numSelfPlayWorkers processes.
+        Every worker has its own copy of the game, the networks of this
+        iteration (on the cpu) and the evaluation cache and its own search tree. With args.inference_server the
+        networks are only held by an InferenceServer process instead, which
+        evaluates the boards of all workers in batches.
+
+        Returns:
+            episodes: a generator of the (white, black) examples of every
+                      episode in the order the episodes are finished
+        """
+        seeds = np.random.randint(2**31, size=self.args.numEps).tolist()
+        inference_server = None
+        if self.args.inference_server:
+            inference_server = InferenceServer(self.game, self.white_nnet, self.black_nnet,
+                                               self.args.numSelfPlayWorkers, max(self.args.mcts_batch_size, 1),
+                                               self.args.inference_max_batch_size, self.args.inference_max_wait)
+            inference_server.start()
+            white_nnet, black_nnet = self.white_nnet, self.black_nnet
+        else:
+            white_nnet, black_nnet = _cpu_copy(self.white_nnet), _cpu_copy(self.black_nnet)
+        # unlike a Pool, the executor doesn't replace a worker that died (which would wait for a free slot of the
+        # inference server forever) but fails with a BrokenProcessPool error
+        executor = ProcessPoolExecutor(self.args.numSelfPlayWorkers, initializer=_init_self_play_worker,
+                                       initargs=(self.game, white_nnet, black_nnet, self.args, inference_server))
+        try:
+            pending = {executor.submit(_execute_worker_episode, seed) for seed in seeds}
+            while pending:
+                done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for episode in done:
+                    yield episode.result()
+                if inference_server is not None:
+                    inference_server.check()
+        finally:
+            executor.shutdown(cancel_futures=True)
+            if inference_server is not None:
+                inference_server.stop()
+
     def getCheckpointFile(self, iteration, player=None):
         return 'checkpoint_' + ('white_' if player == Player.white else 'black_' if player == Player.black else '') + str(iteration) + '.pth.tar'
 
     def saveTrainExamples(self, iteration):
-        folder = self.args.checkpoint
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        filename_white = os.path.join(folder, "training_white.examples")
-        filename_black = os.path.join(folder, "training_black.examples")
-        with open(filename_white, "wb+") as f:
-            Pickler(f).dump(self.trainExamplesHistory_white)
-        with open(filename_black, "wb+") as f:
-            Pickler(f).dump(self.trainExamplesHistory_black)
+        # the shards of the new iterations are already written, only the manifests are updated (and the shards of
+        # the removed iterations deleted)
+        self.trainExamplesHistory_white.save()
+        self.trainExamplesHistory_black.save()
 
     def loadTrainExamples(self):
-        folder = self.args.checkpoint
-        filename_white = os.path.join(folder, "training_white.examples")
-        filename_black = os.path.join(folder, "training_black.examples")
+        filename_white = self.trainExamplesHistory_white.manifest_path()
+        filename_black = self.trainExamplesHistory_black.manifest_path()
         if not os.path.isfile(filename_white) or not os.path.isfile(filename_black):
             print(filename_white)
             print(filename_black)
@@ -261,13 +378,15 @@ class Coach():
                 sys.exit()
         else:
             print("File with trainExamples found. Read it.")
-            with open(filename_white, "rb") as f:
-                self.trainExamplesHistory_white = Unpickler(f).load()
-            with open(filename_black, "rb") as f:
-                self.trainExamplesHistory_black = Unpickler(f).load()
+            # only the manifests are read, the shards are memory-mapped when they are sampled
+            self.trainExamplesHistory_white.load()
+            self.trainExamplesHistory_black.load()
             # examples based on the model were already collected (loaded)
 
     def load_expert_examples(self):
         white, black = read_data(self.args)
-        self.trainExamplesHistory_white.extend(white)
-        self.trainExamplesHistory_black.extend(black)
+        # every part of the expert data becomes one segment of the history
+        for examples in white:
+            self.trainExamplesHistory_white.add_iteration(0, examples)
+        for examples in black:
+            self.trainExamplesHistory_black.add_iteration(0, examples)
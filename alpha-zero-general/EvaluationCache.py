@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+
+# estimated memory of an entry besides the arrays (key tuple, dict and list slots)
+ENTRY_OVERHEAD = 256
+
+
+class EvaluationCache():
+    """
+    Bounded cache of neural network evaluations that is kept across episodes.
+
+    The keys are (Zobrist hash of the board, player to move, nnet.version).
+    NNetWrapper takes a new version whenever its weights change (train and
+    load_checkpoint), so the entries of old weights are never hit again and
+    are evicted like any other least recently used entry.
+    """
+
+    def __init__(self, max_memory_mb=256):
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.memory = 0
+        self.entries = OrderedDict()    # key -> (pi, v), the least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Returns:
+            (pi, v): the stored evaluation of key or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, pi, v):
+        with self.lock:
+            if key in self.entries:
+                return
+            # copies, so that rows of a batch don't keep the whole batch alive
+            pi = pi.copy()
+            v = v.copy()
+            self.entries[key] = (pi, v)
+            self.memory += _entry_memory(pi, v)
+            while self.memory > self.max_memory and self.entries:
+                _, (old_pi, old_v) = self.entries.popitem(last=False)
+                self.memory -= _entry_memory(old_pi, old_v)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.memory = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def __str__(self):
+        return 'entries: {} ({:.1f} MB) | hits: {} | misses: {} | hit rate: {:.3f}'.format(
+            len(self.entries), self.memory / (1024 * 1024), self.hits, self.misses, self.hit_rate())
+
+
+def _entry_memory(pi, v):
+    return pi.nbytes + v.nbytes + ENTRY_OVERHEAD
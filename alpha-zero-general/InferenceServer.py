@@ -0,0 +1,221 @@
+import ctypes
+import multiprocessing
+import queue
+import time
+import traceback
+
+import numpy as np
+
+from tafl.TaflBoard import Player
+
+# CUDA can't be used in a forked process, so the server process is spawned
+_context = multiprocessing.get_context('spawn')
+
+
+class InferenceServer():
+    """
+    A process that owns the white and the black network and evaluates the
+    boards of many self-play workers together.
+
+    Every client (one per worker) has its own slot of shared memory for the
+    boards of a request and the results. A request only sends
+    (client, player, number of boards) over the request queue. The server
+    collects requests until max_batch_size boards are waiting or max_wait
+    seconds have passed since the first one, evaluates them with one
+    predict_batch call per network, writes the results into the slots and
+    notifies the clients over their response queues.
+
+    The server process is spawned and gets the networks and the shared memory
+    when it is started. The shared memory is inherited by the workers, so the
+    server has to be created before the worker processes are forked. If the
+    server fails, every client gets an error marker instead of a response and
+    raises a RuntimeError from then on.
+    """
+
+    def __init__(self, game, white_nnet, black_nnet, num_clients, client_capacity=1, max_batch_size=64,
+                 max_wait=0.002, num_scalar_values=2):
+        self.white_nnet = white_nnet
+        self.black_nnet = black_nnet
+        self.client_capacity = client_capacity     # #boards of one request
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        board_x, board_y = game.getBoardSize()
+        self.board_x = board_x
+        self.board_y = board_y
+        action_size = game.getActionSize()
+
+        # (ctype, shape) of the shared arrays of every client
+        self.shapes = {'boards': (ctypes.c_uint8, (client_capacity, board_x, board_y)),
+                       'scalar_values': (ctypes.c_float, (client_capacity, num_scalar_values)),
+                       'pis': (ctypes.c_float, (client_capacity, action_size)),
+                       'vs': (ctypes.c_float, (client_capacity, 1))}
+        self.shared = {name: [_context.RawArray(ctype, int(np.prod(shape))) for _ in range(num_clients)]
+                       for name, (ctype, shape) in self.shapes.items()}
+        self.create_views()
+
+        self.requests = _context.Queue()
+        self.responses = [_context.Queue() for _ in range(num_clients)]
+        self.free_clients = _context.Queue()
+        for client in range(num_clients):
+            self.free_clients.put(client)
+        self.error = None       # the error message of the server, once a client received it
+        self.process = None
+
+    def create_views(self):
+        # numpy views of the shared memory, self.boards[client] etc.
+        for name, (ctype, shape) in self.shapes.items():
+            setattr(self, name, [np.frombuffer(array, dtype=ctype).reshape(shape) for array in self.shared[name]])
+
+    def __getstate__(self):
+        # the views are created again from the shared memory in the server process
+        state = self.__dict__.copy()
+        for name in self.shapes:
+            del state[name]
+        state['process'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.create_views()
+
+    def start(self):
+        self.process = _context.Process(target=self.serve, daemon=True)
+        self.process.start()
+
+    def stop(self, timeout=10):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.process.join()
+        self.process = None
+
+    def check(self):
+        """
+        Raises a RuntimeError if the server process died. The clients get an
+        error marker then, so that they don't wait for a response forever.
+        """
+        if not self.process.is_alive():
+            message = 'the inference server died with exit code {}'.format(self.process.exitcode)
+            self.fail(message)
+            raise RuntimeError(message)
+
+    def fail(self, message):
+        # error marker for every client
+        for responses in self.responses:
+            responses.put(message)
+
+    def connect(self):
+        """
+        Reserves a client slot for the calling process.
+
+        Returns:
+            (white_nnet, black_nnet): proxies with the predict and predict_batch
+                                      methods of NNetWrapper
+
+        There is one slot per worker and the slots aren't returned, so the
+        workers must not be replaced (see Coach.parallel_episodes).
+        """
+        client = self.free_clients.get()
+        return InferenceClient(self, client, Player.white), InferenceClient(self, client, Player.black)
+
+    def serve(self):
+        # main loop of the server process
+        try:
+            self.serve_requests()
+        except BaseException:
+            self.fail(traceback.format_exc())
+            raise
+
+    def serve_requests(self):
+        stopped = False
+        while not stopped:
+            request = self.requests.get()
+            if request is None:
+                break
+            batch = [request]
+            batch_size = request[2]
+            deadline = time.time() + self.max_wait
+            while batch_size < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopped = True
+                    break
+                batch.append(request)
+                batch_size += request[2]
+            self.evaluate(batch)
+
+    def evaluate(self, batch):
+        """
+        Input:
+            batch: list of requests (client, player, number of boards)
+        """
+        for player, nnet in ((Player.white, self.white_nnet), (Player.black, self.black_nnet)):
+            requests = [request for request in batch if request[1] == player]
+            if not requests:
+                continue
+            boards = np.concatenate([self.boards[client][:n] for client, _, n in requests])
+            scalar_values = np.concatenate([self.scalar_values[client][:n] for client, _, n in requests])
+            pis, vs = nnet.predict_batch(boards, scalar_values)
+            offset = 0
+            for client, _, n in requests:
+                self.pis[client][:n] = pis[offset:offset + n]
+                self.vs[client][:n] = vs[offset:offset + n]
+                offset += n
+                self.responses[client].put(n)
+
+
+class InferenceClient():
+    """
+    Stands in for the network of one player in a worker process and sends the
+    boards to an InferenceServer instead of evaluating them itself.
+    """
+
+    def __init__(self, server, client, player):
+        self.server = server
+        self.client = client
+        self.player = player
+        nnet = server.white_nnet if player == Player.white else server.black_nnet
+        self.version = nnet.version     # the weights don't change while the server runs
+
+    def predict(self, board, scalar_values):
+        pis, vs = self.predict_batch([board], [scalar_values])
+        return pis[0], vs[0]
+
+    def predict_batch(self, boards, scalar_values):
+        """
+        boards: stacked uint8 array of shape (n, board_x, board_y) or list of
+                boards (TaflBoard / TaflBitBoard or np arrays without the border)
+        scalar_values: array of shape (n, num_scalar_values) or list of np arrays
+
+        Returns the policies (n, action_size) and values (n, 1) of all boards.
+        """
+        server = self.server
+        if server.error is not None:
+            raise RuntimeError(server.error)
+        pis = []
+        vs = []
+        # more boards than fit into the slot are sent in several requests
+        for start in range(0, len(boards), server.client_capacity):
+            chunk = boards[start:start + server.client_capacity]
+            n = len(chunk)
+            for i, board in enumerate(chunk):
+                if hasattr(board, 'board'):
+                    board = board.board[1: server.board_x + 1, 1: server.board_y + 1]
+                server.boards[self.client][i] = board
+            server.scalar_values[self.client][:n] = np.asarray(scalar_values[start:start + n]).reshape(n, -1)
+            server.requests.put((self.client, self.player, n))
+            response = server.responses[self.client].get()
+            if isinstance(response, str):
+                server.error = 'the inference server failed:\n' + response
+                raise RuntimeError(server.error)
+            pis.append(server.pis[self.client][:n].copy())
+            vs.append(server.vs[self.client][:n].copy())
+        return np.concatenate(pis), np.concatenate(vs)
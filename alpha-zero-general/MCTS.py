@@ -1,58 +1,71 @@
 import copy
 import math
 import random
+import threading
 import time
 
 import numpy as np
 
+from SearchTree import SearchTree
 from tafl.TaflBoard import Player
 from tafl.TaflGame import MovementType, action_conversion__index_to_explicit
 
 EPS = 1e-8
+VIRTUAL_LOSS = 1    # visits with a loss counted for every edge on the path of a leaf waiting for its evaluation
+MIN_SEARCH_FRACTION = 0.1   # part of the time budget a timed search runs before it may stop early
 
 class MCTS():
     """
     This class handles the MCTS tree.
     """
 
-    def __init__(self, game, white_nnet, black_nnet, args):
+    def __init__(self, game, white_nnet, black_nnet, args, cache=None):
         self.game = game
         self.size = game.getBoardSize()[0]
         self.white_nnet = white_nnet
         self.black_nnet = black_nnet
         self.args = args
-        self.Qsa = {}       # stores Q values for s,a (as defined in the paper)
-        self.Nsa = {}       # stores #times edge s,a was visited
-        self.Ns = {}        # stores #times board s was visited
-        self.Ps = {}        # stores initial policy (returned by neural net)
-
-        self.Es = {}        # stores game.getGameEnded ended for board s
-        self.Vs = {}        # stores game.getValidMoves for board s
-
-    def getActionProb(self, canonicalBoard, this_player, temp=1, time=None):
+        # stores for every board s: game.getGameEnded, #times s was visited and, once s has been expanded, the legal
+        # actions a with their initial policy (returned by neural net), #times edge s,a was visited and the sum of
+        # the values backed up through s,a (Q = value sum / visits as defined in the paper)
+        self.tree = SearchTree()
+        # EvaluationCache shared with the following searches (may be None)
+        self.cache = cache
+        self.ponder_thread = None
+        self.pondering = None       # threading.Event, cleared to stop the pondering thread
+
+    def getActionProb(self, canonicalBoard, this_player, temp=1, time_budget=None, sparse=False):
         """
         This function performs numMCTSSims simulations of MCTS starting from
-        canonicalBoard.
+        canonicalBoard, or searches for time_budget seconds if that is given.
 
         Returns:
             probs: a policy vector where the probability of the ith action is
-                   proportional to Nsa[(s,a)]**(1./temp)
+                   proportional to N(s,a)**(1./temp). With sparse set, the
+                   policy is returned as (indices, probs): the actions with a
+                   probability > 0 in ascending order and their probabilities
         """
-        if time is None:
-            for i in range(self.args.numMCTSSims):
-                # print("    search number " + str(i))
-                self.search(copy.deepcopy(canonicalBoard), this_player)
+        # the tree can't be searched by the pondering thread at the same time
+        self.stop_pondering()
+
+        if self.args.reuse_tree:
+            self.promote_root(canonicalBoard, this_player)
+
+        # search walks the tree on canonicalBoard itself and takes all moves back afterwards
+        if time_budget is None:
+            simulations = 0
+            while simulations < self.args.numMCTSSims:
+                # print("    search number " + str(simulations))
+                simulations += self.simulate(canonicalBoard, this_player, self.args.numMCTSSims - simulations)
         else:
-            timeout = time.time() + time
-            while time.time() < timeout:
-                self.search(copy.deepcopy(canonicalBoard), this_player)
+            self.timed_search(canonicalBoard, this_player, time_budget)
 
-        # bytes are much faster
-        s = self.game.stringRepresentation(canonicalBoard) + this_player.to_bytes(1, byteorder='big', signed=True)
-        # s = self.game.stringRepresentation(canonicalBoard) + str(this_player)   # this addition is needed so that
-        # the search algorithm doesn't get confused when the same board state as before is reached, but it's the
-        # other player's turn
-        counts = [self.Nsa[(s,a)] if (s,a) in self.Nsa else 0 for a in range(self.game.getActionSize())]
+        # the key includes the player so that the search algorithm doesn't get confused when the same board state as
+        # before is reached, but it's the other player's turn
+        s = self.game.stringRepresentation(canonicalBoard, this_player)
+        if sparse:
+            return self.sparse_action_prob(self.tree.find(s), temp)
+        counts = self.tree.action_counts(self.tree.find(s), self.game.getActionSize()).tolist()
 
         if temp == 0:
             maximum = max(counts)
@@ -66,6 +79,131 @@ class MCTS():
         probs = [x/float(sum(counts)) for x in counts]
         return probs
 
+    def root_visits(self, canonicalBoard, this_player):
+        """
+        Returns:
+            visits: the number of visits of the actions of canonicalBoard that
+                    the last getActionProb turned into its policy (including
+                    the visits kept from earlier searches with
+                    args.reuse_tree)
+        """
+        s = self.game.stringRepresentation(canonicalBoard, this_player)
+        return int(self.tree.action_visits(self.tree.find(s))[1].sum())
+
+    def sparse_action_prob(self, node, temp):
+        # the same policy as the dense one of getActionProb (and the same random choice for temp=0), but only for the
+        # visited actions
+        actions, counts = self.tree.action_visits(node)
+        if len(actions) == 0:
+            raise ZeroDivisionError("no action of the root was visited")
+        if temp == 0:
+            argmaxs = actions[counts == counts.max()].tolist()
+            return np.array([random.choice(argmaxs)]), np.ones(1)
+        counts = counts.astype(np.float64)**(1./temp)
+        return actions, counts/counts.sum()
+
+    def timed_search(self, canonicalBoard, this_player, time_budget):
+        """
+        Runs simulations until time_budget seconds have passed, or until the
+        most visited action of canonicalBoard can't be overtaken any more by
+        the simulations that fit into the remaining time (estimated from the
+        speed of the simulations of this call). The search doesn't stop early
+        before it ran at least one batch and MIN_SEARCH_FRACTION of the
+        budget, otherwise a reused or pondered root could be played as it is.
+        """
+        s = self.game.stringRepresentation(canonicalBoard, this_player)
+        start = time.time()
+        deadline = start + time_budget
+        earliest_stop = start + MIN_SEARCH_FRACTION * time_budget
+        min_simulations = max(self.args.mcts_batch_size, 1)
+        simulations = 0
+        while True:
+            now = time.time()
+            if now >= deadline:
+                break
+            root = self.tree.find(s)
+            if simulations >= min_simulations and now >= earliest_stop and root is not None:
+                remaining_simulations = simulations / max(now - start, EPS) * (deadline - now)
+                if self.is_decided(root, remaining_simulations):
+                    break
+            simulations += self.simulate(canonicalBoard, this_player, self.args.mcts_batch_size)
+
+    def is_decided(self, root, remaining_simulations):
+        """
+        Returns:
+            decided: True if no other action of root can reach the visit count
+                     of the most visited one within remaining_simulations
+        """
+        start, end = self.tree.children(root)
+        if end - start < 2:
+            return True
+        second, best = np.partition(self.tree.child_visits[start:end], -2)[-2:]
+        return best - second > remaining_simulations
+
+    def start_pondering(self, board, player):
+        """
+        Searches board (the position after the own move, player is the
+        opponent) in a background thread until stop_pondering is called or
+        its root has args.numMCTSSims visits, so that the tree doesn't grow
+        without bound while the opponent thinks. With
+        args.reuse_tree the next getActionProb keeps the statistics of the
+        position the opponent actually chose.
+        """
+        self.stop_pondering()
+        # the caller may go on playing on board
+        board = copy.deepcopy(board)
+        if self.args.reuse_tree:
+            self.promote_root(board, player)
+        self.pondering = threading.Event()
+        self.pondering.set()
+        self.ponder_thread = threading.Thread(target=self.ponder, args=(board, player, self.pondering), daemon=True)
+        self.ponder_thread.start()
+
+    def stop_pondering(self):
+        if self.ponder_thread is None:
+            return
+        self.pondering.clear()
+        self.ponder_thread.join()
+        self.ponder_thread = None
+
+    def ponder(self, board, player, pondering):
+        # main loop of the pondering thread
+        s = self.game.stringRepresentation(board, player)
+        while pondering.is_set() and self.game.getGameEnded(board, player) == 0:
+            root = self.tree.find(s)
+            visits = 0 if root is None else int(self.tree.visits[root])
+            if visits >= self.args.numMCTSSims:
+                break
+            self.simulate(board, player, self.args.numMCTSSims - visits)
+
+    def reset(self):
+        # forget all searches
+        self.tree = SearchTree()
+
+    def promote_root(self, canonicalBoard, this_player):
+        """
+        Makes the node of canonicalBoard the root of the tree. The statistics
+        of its subtree are kept from the searches of the previous moves and
+        the rest of the tree is released.
+        """
+        root = self.tree.find(self.game.stringRepresentation(canonicalBoard, this_player))
+        if root is None:
+            self.reset()
+        elif root != 0:
+            self.tree.compact(root)
+
+    def simulate(self, canonicalBoard, this_player, max_simulations):
+        """
+        Runs one search, or one batch of up to args.mcts_batch_size searches
+        whose leaves are evaluated together if that is greater than 1.
+
+        Returns:
+            simulations: the number of simulations that were run
+        """
+        if self.args.mcts_batch_size > 1:
+            return self.search_batch(canonicalBoard, this_player, min(self.args.mcts_batch_size, max_simulations))
+        self.search(canonicalBoard, this_player)
+        return 1
 
     def search(self, canonicalBoard, this_player):
         """
@@ -76,20 +214,131 @@ class MCTS():
         Once a leaf node is found, the neural network is called to return an
         initial policy P and a value v for the state. This value is propogated
         up the search path. In case the leaf node is a terminal state, the
-        outcome is propogated up the search path. The values of Ns, Nsa, Qsa are
-        updated.
+        outcome is propogated up the search path. The visit counts and value
+        sums of the tree are updated.
 
         NOTE: the return values are the negative of the value of the current
         state. This is done since v is in [-1,1] and if v is the value of a
         state for the current player, then its value is -v for the other player.
 
+        The moves of the search path are made on canonicalBoard with push() and
+        taken back with pop() before returning, so the board is left unchanged.
+
         Returns:
             v: the negative of the value of the current canonicalBoard
         """
+        tree = self.tree
+        # getValidMoves can end the game on the root board if there are no moves left
+        root_outcome = canonicalBoard.outcome
+
+        value_stack, node, next_player = self.descend(canonicalBoard, this_player)
+        if node is None:
+            self.take_back(canonicalBoard, len(value_stack), root_outcome)
+            return
+
+        if tree.ended[node] != 0:
+            # terminal node
+            last_iteration_v = -tree.ended[node]
+        else:
+            # leaf node
+            valids = self.game.getValidMoves(canonicalBoard, next_player)
+
+            # occurrences = np.zeros(self.size * self.size * self.size * 2)
+            # for index, action in enumerate(valids):
+            #     if action == 1 and index != self.size * self.size * self.size * 2:
+            #         explicit = action_conversion__index_to_explicit(index, self.size)
+            #        occurrences[index] = 1 if canonicalBoard.would_next_board_be_second_third(2, explicit) else 0
+
+            pi, v = self.evaluate(canonicalBoard, next_player)
+            # valids = self.game.getValidMoves(canonicalBoard, next_player)
+            self.expand(node, valids, pi)
+            last_iteration_v = -np.asarray(v).item()
+
+        self.take_back(canonicalBoard, len(value_stack), root_outcome)
+
+        return self.backup(value_stack, last_iteration_v)
 
-        def player_net(player):
-            return self.white_nnet if player == Player.white else self.black_nnet
+    def search_batch(self, canonicalBoard, this_player, batch_size):
+        """
+        Performs up to batch_size iterations of MCTS, but instead of calling
+        the neural network for each leaf separately, the leaves are collected
+        and evaluated with one predict_batch call per network afterwards.
+
+        While a leaf waits for its evaluation, every edge on its path counts
+        a virtual loss, so that the following searches of the batch are
+        steered to other parts of the tree. If a search still ends in a leaf
+        that is already waiting, the batch is closed early.
+
+        Returns:
+            simulations: the number of simulations that were run
+        """
+        tree = self.tree
+        root_outcome = canonicalBoard.outcome
+        pending = set()     # the leaf nodes waiting for their evaluation
+        leaves = []         # (value_stack, node, player, valids, cache key, board, scalar_values) of every pending leaf
+        simulations = 0
+
+        for _ in range(batch_size):
+            value_stack, node, next_player = self.descend(canonicalBoard, this_player)
+            depth = len(value_stack)
+            if node is None:
+                # aborted search
+                simulations += 1
+            elif tree.ended[node] != 0:
+                # terminal node
+                self.backup(value_stack, -tree.ended[node])
+                simulations += 1
+            elif node in pending:
+                self.take_back(canonicalBoard, depth, root_outcome)
+                break
+            else:
+                # leaf node
+                valids = self.game.getValidMoves(canonicalBoard, next_player)
+                key = self.cache_key(canonicalBoard, next_player)
+                cached = self.cache.get(key) if key is not None else None
+                if cached is not None:
+                    self.expand(node, valids, cached[0])
+                    self.backup(value_stack, -np.asarray(cached[1]).item())
+                    simulations += 1
+                else:
+                    pending.add(node)
+                    leaves.append((value_stack, node, next_player, valids, key,
+                                   canonicalBoard.board[1:self.size + 1, 1:self.size + 1].copy(),
+                                   np.array([canonicalBoard.king_position[0], canonicalBoard.king_position[1]])))
+                    for parent, child in value_stack:
+                        tree.apply_virtual_loss(parent, child, VIRTUAL_LOSS)
+            self.take_back(canonicalBoard, depth, root_outcome)
+
+        for player in (Player.white, Player.black):
+            player_leaves = [leaf for leaf in leaves if leaf[2] == player]
+            if not player_leaves:
+                continue
+            pis, vs = self.player_net(player).predict_batch([leaf[5] for leaf in player_leaves],
+                                                            [leaf[6] for leaf in player_leaves])
+            for (value_stack, node, _, valids, key, _, _), pi, v in zip(player_leaves, pis, vs):
+                for parent, child in value_stack:
+                    tree.apply_virtual_loss(parent, child, -VIRTUAL_LOSS)
+                if key is not None:
+                    self.cache.put(key, pi, v)
+                self.expand(node, valids, pi)
+                self.backup(value_stack, -np.asarray(v).item())
+
+        return simulations + len(leaves)
+
+    def descend(self, canonicalBoard, this_player):
+        """
+        Walks down the tree from canonicalBoard, always taking the action with
+        the highest upper confidence bound, until a terminal node or a node
+        that hasn't been expanded yet is reached. The moves are made on
+        canonicalBoard and need to be taken back with take_back.
 
+        Returns:
+            value_stack: the (node, child) pairs of the path
+            node: the node at the end of the path or None if the search had to
+                  be aborted
+            next_player: the player to move at node
+        """
+        tree = self.tree
         value_stack = []
         next_player = this_player
         iteration = 0
@@ -101,91 +350,117 @@ class MCTS():
             iteration += 1
             if iteration > 1000:
                 print("more MCTS search iterations than the maximum, breaking out of possibly infinite loop!")
-                return
+                return value_stack, None, next_player
 
             # workaround end
 
-            # bytes are much faster
-            s = self.game.stringRepresentation(canonicalBoard) + next_player.to_bytes(1, byteorder='big', signed=True)
-            # s = self.game.stringRepresentation(canonicalBoard) + str(next_player)   # this addition is needed so that
-            # the search algorithm doesn't get confused when the same board state as before is reached, but it's the
-            # other player's turn
+            # Zobrist key of the board state and the player to move
+            s = self.game.stringRepresentation(canonicalBoard, next_player)
 
-            if s not in self.Es:
-                self.Es[s] = self.game.getGameEnded(canonicalBoard, next_player)
-            if self.Es[s] != 0:
-                # terminal node
-                last_iteration_v = -self.Es[s]
-                break
+            node = tree.find(s)
+            if node is None:
+                node = tree.add(s, self.game.getGameEnded(canonicalBoard, next_player))
+            if value_stack:
+                tree.link(value_stack[-1][1], node)
+            if tree.ended[node] != 0 or not tree.is_expanded(node):
+                return value_stack, node, next_player
 
-            if s not in self.Ps:
-                # leaf node
-                valids = self.game.getValidMoves(canonicalBoard, next_player)
+            # pick the action with the highest upper confidence bound
+            best_child = self.select_child(node)
 
-                # occurrences = np.zeros(self.size * self.size * self.size * 2)
-                # for index, action in enumerate(valids):
-                #     if action == 1 and index != self.size * self.size * self.size * 2:
-                #         explicit = action_conversion__index_to_explicit(index, self.size)
-                #        occurrences[index] = 1 if canonicalBoard.would_next_board_be_second_third(2, explicit) else 0
-
-                self.Ps[s], v = player_net(next_player).predict(canonicalBoard, np.array([canonicalBoard.king_position[0], canonicalBoard.king_position[1]]))
-                # valids = self.game.getValidMoves(canonicalBoard, next_player)
-                self.Ps[s] = self.Ps[s] * valids  # masking invalid moves
-                sum_Ps_s = np.sum(self.Ps[s])
-                if sum_Ps_s > 0:
-                    self.Ps[s] /= sum_Ps_s  # renormalize
-                else:
-                    # if all valid moves were masked make all valid moves equally probable
-
-                    # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
-                    # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.
-                    print("All valid moves were masked, do workaround.")
-                    print(valids)
-                    self.Ps[s] = self.Ps[s] + valids
-                    self.Ps[s] /= np.sum(self.Ps[s])
-
-                self.Vs[s] = valids
-                self.Ns[s] = 0
-                last_iteration_v = -v
-                break
+            a = int(tree.actions[best_child])
 
-            valids = self.Vs[s]
-            cur_best = -float('inf')
-            best_act = -1
+            next_s, next_player = self.game.getNextState(canonicalBoard, next_player, a, undoable=True)
+            canonicalBoard = self.game.getCanonicalForm(next_s, next_player)
 
-            # pick the action with the highest upper confidence bound
-            for a in range(self.game.getActionSize()):
-                if valids[a]:
-                    if (s, a) in self.Qsa:
-                        u = self.Qsa[(s, a)] + self.args.cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s]) / (
-                                    1 + self.Nsa[(s, a)])
-                    else:
-                        u = self.args.cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s] + EPS)  # Q = 0 ?
+            value_stack.append((node, best_child))
 
-                    if u > cur_best:
-                        cur_best = u
-                        best_act = a
+    def evaluate(self, canonicalBoard, player):
+        """
+        Returns:
+            (pi, v): the evaluation of canonicalBoard by the network of player,
+                     taken from the cache if possible
+        """
+        key = self.cache_key(canonicalBoard, player)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        pi, v = self.player_net(player).predict(canonicalBoard, np.array([canonicalBoard.king_position[0], canonicalBoard.king_position[1]]))
+        if key is not None:
+            self.cache.put(key, pi, v)
+        return pi, v
+
+    def cache_key(self, canonicalBoard, player):
+        # the evaluation only depends on the pieces (and the king position given by them) and the network
+        if self.cache is None:
+            return None
+        return canonicalBoard.zobrist_hash, player, self.player_net(player).version
+
+    def expand(self, node, valids, pi):
+        """
+        Stores the legal actions of node with the policy pi of the neural
+        network (masked and renormalized) as their priors.
+        """
+        # only the legal actions are stored
+        actions = np.flatnonzero(valids)
+        priors = pi[actions]  # masking invalid moves
+        sum_priors = np.sum(priors)
+        if sum_priors > 0:
+            priors = priors / sum_priors  # renormalize
+        else:
+            # if all valid moves were masked make all valid moves equally probable
 
-            a = best_act
+            # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
+            # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.
+            print("All valid moves were masked, do workaround.")
+            print(valids)
+            priors = np.full(len(actions), 1 / len(actions))
 
-            next_s, next_player = self.game.getNextState(canonicalBoard, next_player, a)
-            canonicalBoard = self.game.getCanonicalForm(next_s, next_player)
+        self.tree.expand(node, actions, priors)
 
-            value_stack.append((s, a))
+    def backup(self, value_stack, last_iteration_v):
+        """
+        Propagates the value of the last node of a search path up the path.
 
+        Returns:
+            v: the negative of the value of the first node of the path
+        """
         # take from stack
         while len(value_stack) > 0:
-            s, a = value_stack.pop()
+            node, child = value_stack.pop()
+            self.tree.backup(node, child, last_iteration_v)
+            last_iteration_v = -last_iteration_v
 
-            if (s, a) in self.Qsa:
-                self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + last_iteration_v) / (self.Nsa[(s, a)] + 1)
-                self.Nsa[(s, a)] += 1
+        return -last_iteration_v
 
-            else:
-                self.Qsa[(s, a)] = last_iteration_v
-                self.Nsa[(s, a)] = 1
+    def player_net(self, player):
+        return self.white_nnet if player == Player.white else self.black_nnet
 
-            self.Ns[s] += 1
-            last_iteration_v = -last_iteration_v
+    def select_child(self, node):
+        """
+        Computes the upper confidence bounds of all legal actions of node in
+        one vectorized expression (in float64, so that the result is exactly
+        the one of the scalar formula).
 
-        return -last_iteration_v
+        Returns:
+            child: the index into the child pools of the tree of the action
+                   with the highest upper confidence bound (the first one on ties)
+        """
+        tree = self.tree
+        start, end = tree.children(node)
+        node_visits = int(tree.visits[node])
+        visits = tree.child_visits[start:end]
+        priors = tree.priors[start:end].astype(np.float64)
+        q = tree.value_sums[start:end].astype(np.float64) / np.maximum(visits, 1)
+        u = np.where(visits > 0,
+                     q + self.args.cpuct * priors * math.sqrt(node_visits) / (1 + visits),
+                     self.args.cpuct * priors * math.sqrt(node_visits + EPS))  # Q = 0 ?
+        return start + int(np.argmax(u))
+
+    @staticmethod
+    def take_back(board, moves, root_outcome):
+        # undo the moves of a search path
+        for _ in range(moves):
+            board.pop()
+        board.outcome = root_outcome
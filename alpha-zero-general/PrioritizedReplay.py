@@ -0,0 +1,128 @@
+import numpy as np
+
+from ReplayBuffer import HistorySampler
+
+
+class SumTree():
+    """
+    Binary tree over the priorities of n examples in one array: the leaves
+    tree[capacity + i] hold the priorities, every inner node tree[k] the sum
+    of its children tree[2k] and tree[2k + 1], the root tree[1] the total.
+
+    update() and sample() process whole batches of indices level by level,
+    i.e. with O(log n) vectorized steps.
+    """
+
+    def __init__(self, priorities):
+        self.size = len(priorities)
+        self.capacity = 1
+        while self.capacity < max(self.size, 1):
+            self.capacity *= 2
+        self.depth = self.capacity.bit_length() - 1
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+        self.tree[self.capacity:self.capacity + self.size] = priorities
+        # the levels from the bottom up, each node is the sum of the two below
+        start = self.capacity
+        while start > 1:
+            self.tree[start // 2:start] = self.tree[start:2 * start].reshape(-1, 2).sum(axis=1)
+            start //= 2
+
+    def total(self):
+        return self.tree[1]
+
+    def priorities(self, indices):
+        return self.tree[self.capacity + np.asarray(indices, dtype=np.int64)]
+
+    def update(self, indices, priorities):
+        """
+        Sets the priorities of the examples at indices (the last one counts if
+        an index occurs more than once).
+        """
+        nodes = self.capacity + np.asarray(indices, dtype=np.int64)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def sample(self, batch_size):
+        """
+        Returns:
+            indices: batch_size example indices drawn in proportion to their
+                     priorities, one from each of batch_size equal strata of
+                     the total priority (which avoids most duplicates)
+        """
+        targets = (np.arange(batch_size) + np.random.random(batch_size)) * (self.total() / batch_size)
+        nodes = np.ones(batch_size, dtype=np.int64)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            go_right = targets >= left
+            targets -= left * go_right
+            nodes = 2 * nodes + go_right
+        # rounding can end up right of the last example
+        return np.minimum(nodes - self.capacity, self.size - 1)
+
+
+class PrioritizedSampler(HistorySampler):
+    """
+    HistorySampler that draws the examples in proportion to
+    weight * priority**alpha, where weight is the recency (and count) weight
+    of the HistorySampler and priority the last training loss of the example
+    (+ epsilon). Examples that weren't trained on yet get the highest
+    priority so far.
+
+    The priorities of the examples are kept per segment, so they survive the
+    eviction of the oldest iterations; the sum tree is rebuilt when the
+    segments of the buffer change. importance_weights() returns the loss
+    weights that correct the training for the prioritization, annealed by
+    beta (0: no correction, 1: full correction).
+    """
+
+    def __init__(self, buffer, alpha=0.6, beta=0.4, epsilon=1e-3, recency_decay=1.0, count_exponent=1.0):
+        super().__init__(buffer, recency_decay, count_exponent)
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.priorities = {}    # segment -> priorities of its examples
+        self.max_priority = 1.0
+        self.tree = None
+        self.tree_segments = None
+        self.tree_offsets = None
+        self.base_weights = None
+
+    def sync(self):
+        # rebuilds the tree if segments were added or evicted since it was built
+        segments = list(self.buffer.segments)
+        if self.tree is not None and segments == self.tree_segments:
+            return
+        self.priorities = {segment: self.priorities.get(segment, None) for segment in segments}
+        for segment in segments:
+            if self.priorities[segment] is None:
+                self.priorities[segment] = np.full(len(segment), self.max_priority)
+        self.base_weights = self.example_weights()
+        priorities = np.concatenate([self.priorities[segment] for segment in segments]) if segments else np.zeros(0)
+        self.tree = SumTree(self.base_weights * priorities ** self.alpha)
+        self.tree_segments = segments
+        self.tree_offsets = self.buffer.offsets.copy()
+
+    def sample(self, batch_size):
+        self.sync()
+        return self.tree.sample(batch_size)
+
+    def importance_weights(self, indices):
+        # (probability under the base weights / probability under the priorities)**beta, scaled to a maximum of 1
+        probabilities = self.tree.priorities(indices) / self.tree.total()
+        base_probabilities = self.base_weights[indices] / self.base_weights.sum()
+        weights = (base_probabilities / np.maximum(probabilities, 1e-12)) ** self.beta
+        return (weights / weights.max()).astype(np.float32)
+
+    def update_priorities(self, indices, losses):
+        self.sync()
+        indices = np.asarray(indices, dtype=np.int64)
+        priorities = np.asarray(losses, dtype=np.float64) + self.epsilon
+        self.max_priority = max(self.max_priority, priorities.max())
+        segment_indices = np.searchsorted(self.tree_offsets, indices, side='right') - 1
+        for segment_index in np.unique(segment_indices):
+            rows = segment_indices == segment_index
+            self.priorities[self.tree_segments[segment_index]][indices[rows] - self.tree_offsets[segment_index]] = \
+                priorities[rows]
+        self.tree.update(indices, self.base_weights[indices] * priorities ** self.alpha)
@@ -0,0 +1,465 @@
+import json
+import os
+
+import numpy as np
+
+# the columns of the examples and their types. The boards are the TileStates without the border, the scalar values
+# hold the king position. counts is the number of merged occurrences of the position (1 unless the buffer aggregates
+# the positions). The policies are stored sparse in CSR form: the policy of the i-th example of a segment has the
+# probabilities pi_values[pi_offsets[i]:pi_offsets[i + 1]] at the action indices pi_indices[...]
+COLUMN_TYPES = {
+    'boards': np.uint8,
+    'values': np.float32,
+    'scalar_values': np.int8,
+    'counts': np.int32,
+    'pi_offsets': np.int64,
+    'pi_indices': np.int16,
+    'pi_values': np.float16,
+}
+
+
+def sparse_policy(pi):
+    """
+    Returns:
+        (indices, probs): pi as a sparse policy, pi may already be one (see
+                          MCTS.getActionProb) or a dense policy vector
+    """
+    if isinstance(pi, tuple):
+        return pi
+    pi = np.asarray(pi)
+    indices = np.flatnonzero(pi)
+    return indices, pi[indices]
+
+
+class ReplaySegment():
+    """
+    The examples of one iteration of self-play (or one part of the expert
+    data), stored column by column. A segment of a buffer with a folder is a
+    shard: its columns are .npy files that are only memory-mapped when they
+    are read for the first time.
+    """
+
+    def __init__(self, iteration, size, columns=None, shard=None, paths=None):
+        self.iteration = iteration
+        self.size = size
+        self.shard = shard              # number of the shard, names its files
+        self.paths = paths or {}        # column name -> file of the shard
+        self.loaded_columns = columns   # column name -> array (np.memmap for shards)
+
+    @property
+    def columns(self):
+        if self.loaded_columns is None:
+            self.loaded_columns = {column: np.load(path, mmap_mode='r') for column, path in self.paths.items()}
+        return self.loaded_columns
+
+    def __len__(self):
+        return self.size
+
+
+class ReplayBuffer():
+    """
+    Columnar storage of the training examples of the last iterations, which
+    replaces the lists of deques of (board, pi, v, scalar_values) tuples.
+
+    Every iteration is added as one segment with an array per column (see
+    COLUMN_TYPES). The policies stay sparse, they are only densified in the
+    training batches. The oldest iterations are evicted as a whole with
+    pop_oldest().
+
+    With symmetry_tables (see tafl/SymmetryTables.py), the buffer holds only
+    the canonical examples and batch() applies a random symmetry to every
+    example it returns.
+
+    With aggregate set, the examples of the same position (board and king
+    position, the side to move is the same in the buffer of a player) within
+    an iteration are merged into one with the mean policy and value and
+    their count, see aggregate_positions(). HistorySampler weights the merged
+    examples by their counts.
+
+    With a folder, the history is persistent and append-only: every segment
+    is written once as a shard of .npy files and memory-mapped, so that the
+    history doesn't have to fit into memory. save() only writes the manifest
+    (the list of the shards) and deletes the shards that were evicted since
+    the last save. load() reads the manifest, the shards are mapped lazily.
+
+    The examples are addressed by a global index over all segments. The
+    trainer reads them with batch(indices).
+    """
+
+    def __init__(self, board_size, action_size, num_scalar_values=2, folder=None, symmetry_tables=None,
+                 aggregate=False):
+        self.board_x, self.board_y = board_size
+        self.action_size = action_size
+        self.num_scalar_values = num_scalar_values
+        self.folder = folder
+        self.symmetry_tables = symmetry_tables
+        self.aggregate = aggregate
+        self.segments = []
+        # offsets[i] is the global index of the first example of segment i, offsets[-1] the number of examples
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.next_shard = 0
+        # the shard files listed in the manifest on disk, they are deleted when the next manifest doesn't list them
+        self.saved_paths = set()
+        if folder is not None and os.path.isfile(self.manifest_path()):
+            manifest = self.read_manifest()
+            # new shards never overwrite the files of the saved history
+            self.next_shard = manifest['next_shard']
+            self.saved_paths = self.manifest_paths(manifest)
+
+    @classmethod
+    def from_examples(cls, examples, board_size, action_size, num_scalar_values=2):
+        """
+        Returns an in-memory buffer holding examples, a list of
+        (board, pi, v, scalar_values) tuples.
+        """
+        buffer = cls(board_size, action_size, num_scalar_values)
+        buffer.add_iteration(0, examples)
+        return buffer
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def num_iterations(self):
+        return len(self.segments)
+
+    def add_iteration(self, iteration, examples):
+        """
+        Input:
+            iteration: number of the iteration that played the examples
+            examples: iterable of (board, pi, v, scalar_values) or
+                      (board, pi, v, scalar_values, visits), pi sparse or
+                      dense. visits is the number of root visits of the
+                      search that produced pi (1 if it is missing), the
+                      weight of pi when positions are aggregated
+        """
+        examples = list(examples)
+        n = len(examples)
+        boards = np.empty((n, self.board_x, self.board_y), dtype=COLUMN_TYPES['boards'])
+        values = np.empty(n, dtype=COLUMN_TYPES['values'])
+        scalar_values = np.empty((n, self.num_scalar_values), dtype=COLUMN_TYPES['scalar_values'])
+        visits = np.ones(n)
+        pis = []
+        for i, example in enumerate(examples):
+            board, pi, v, scalars = example[:4]
+            boards[i] = board
+            pis.append(sparse_policy(pi))
+            values[i] = v
+            scalar_values[i] = scalars
+            if len(example) > 4:
+                visits[i] = example[4]
+        pi_offsets = np.cumsum([0] + [len(indices) for indices, _ in pis])
+        pi_indices = np.concatenate([indices for indices, _ in pis]) if pis else np.zeros(0)
+        pi_values = np.concatenate([probs for _, probs in pis]) if pis else np.zeros(0)
+        counts = None
+        if self.aggregate:
+            boards, values, scalar_values, counts, pi_offsets, pi_indices, pi_values = aggregate_positions(
+                self.action_size, boards, values, scalar_values, pi_offsets, pi_indices, pi_values, visits)
+        self.add_columns(iteration, boards, values, scalar_values, pi_offsets, pi_indices, pi_values, counts)
+
+    def add_columns(self, iteration, boards, values, scalar_values, pi_offsets, pi_indices, pi_values, counts=None):
+        """
+        Adds the examples of an iteration that are already stacked into one
+        array per column (see COLUMN_TYPES).
+        """
+        if counts is None:
+            counts = np.ones(len(values))
+        columns = {'boards': boards, 'values': values, 'scalar_values': scalar_values, 'counts': counts,
+                   'pi_offsets': pi_offsets, 'pi_indices': pi_indices, 'pi_values': pi_values}
+        columns = {column: np.asarray(array, dtype=COLUMN_TYPES[column]) for column, array in columns.items()}
+        if self.folder is None:
+            self.segments.append(ReplaySegment(iteration, len(columns['values']), columns))
+        else:
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            shard = self.next_shard
+            self.next_shard += 1
+            paths = {column: self.shard_path(shard, column) for column in COLUMN_TYPES}
+            for column, array in columns.items():
+                np.save(paths[column], array)
+            # the arrays are dropped, the shard is mapped when it is read
+            self.segments.append(ReplaySegment(iteration, len(columns['values']), shard=shard, paths=paths))
+        self.update_offsets()
+
+    def pop_oldest(self):
+        """
+        Evicts the examples of the oldest iteration. The files of a shard are
+        deleted with the next save(), or right away if they were never saved.
+        """
+        segment = self.segments.pop(0)
+        segment.loaded_columns = None
+        for path in segment.paths.values():
+            if path not in self.saved_paths:
+                os.remove(path)
+        self.update_offsets()
+
+    def clear(self):
+        while self.segments:
+            self.pop_oldest()
+
+    def update_offsets(self):
+        self.offsets = np.concatenate(([0], np.cumsum([len(segment) for segment in self.segments]))).astype(np.int64)
+
+    def batch(self, indices, symmetries=None):
+        """
+        Input:
+            indices: array of global example indices
+            symmetries: array with the number of the symmetry to apply to
+                        every example (only if the buffer has symmetry_tables)
+
+        Returns:
+            (boards, pis, values, scalar_values): the columns of the examples as
+                                                  arrays (pis as dense float32
+                                                  policy vectors)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        n = len(indices)
+        boards = np.empty((n, self.board_x, self.board_y), dtype=COLUMN_TYPES['boards'])
+        pis = np.zeros((n, self.action_size), dtype=np.float32)
+        values = np.empty(n, dtype=COLUMN_TYPES['values'])
+        scalar_values = np.empty((n, self.num_scalar_values), dtype=COLUMN_TYPES['scalar_values'])
+        if self.symmetry_tables is None:
+            symmetries = None
+        # the actions the policy entries are scattered to, mapped into the symmetry of their example
+        action_targets = self.symmetry_tables.action_targets if symmetries is not None else None
+        segment_indices = np.searchsorted(self.offsets, indices, side='right') - 1
+        for segment_index in np.unique(segment_indices):
+            rows = segment_indices == segment_index
+            local = indices[rows] - self.offsets[segment_index]
+            columns = self.segments[segment_index].columns
+            boards[rows] = columns['boards'][local]
+            values[rows] = columns['values'][local]
+            scalar_values[rows] = columns['scalar_values'][local]
+
+            # densify the policies: every nonzero entry is scattered into its row of the batch
+            starts = columns['pi_offsets'][local]
+            lengths = columns['pi_offsets'][local + 1] - starts
+            entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            entry_rows = np.repeat(np.flatnonzero(rows), lengths)
+            actions = columns['pi_indices'][entries]
+            if action_targets is not None:
+                actions = action_targets[symmetries[entry_rows], actions]
+            pis[entry_rows, actions] = columns['pi_values'][entries]
+
+        if symmetries is not None:
+            tables = self.symmetry_tables
+            boards = boards.reshape(n, -1)[np.arange(n)[:, None], tables.board_indices[symmetries]].reshape(boards.shape)
+            # the scalar values hold the king position
+            scalar_values = tables.king_positions[symmetries, scalar_values[:, 0], scalar_values[:, 1]].astype(
+                COLUMN_TYPES['scalar_values'])
+        return boards, pis, values, scalar_values
+
+    def shard_path(self, shard, column):
+        return os.path.join(self.folder, 'shard_{}_{}.npy'.format(shard, column))
+
+    def manifest_path(self):
+        return os.path.join(self.folder, 'manifest.json')
+
+    def read_manifest(self):
+        with open(self.manifest_path()) as f:
+            return json.load(f)
+
+    def save(self):
+        """
+        Writes the manifest of the shards of a buffer with a folder. The
+        shards themselves were already written when they were added.
+        """
+        manifest = {
+            'board_size': [self.board_x, self.board_y],
+            'action_size': self.action_size,
+            'num_scalar_values': self.num_scalar_values,
+            'next_shard': self.next_shard,
+            'canonical_examples': self.symmetry_tables is not None,
+            'aggregated': self.aggregate,
+            'segments': [{'iteration': segment.iteration, 'size': segment.size, 'shard': segment.shard}
+                         for segment in self.segments],
+        }
+        # the new manifest replaces the old one atomically, so that a crash leaves one of them intact
+        temp_path = self.manifest_path() + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(temp_path, self.manifest_path())
+
+        paths = self.manifest_paths(manifest)
+        for path in self.saved_paths - paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.saved_paths = paths
+
+    def load(self):
+        """
+        Replaces the examples with the history saved in the folder.
+
+        Returns:
+            found: whether the folder contains a saved history
+        """
+        if not os.path.isfile(self.manifest_path()):
+            return False
+        manifest = self.read_manifest()
+        assert tuple(manifest['board_size']) == (self.board_x, self.board_y) \
+            and manifest['action_size'] == self.action_size, "the saved history is for a different board size"
+        assert manifest.get('canonical_examples', False) == (self.symmetry_tables is not None), \
+            "the saved history was stored with a different store_symmetries setting"
+        assert manifest.get('aggregated', False) == self.aggregate, \
+            "the saved history was stored with a different aggregate_positions setting"
+        self.clear()
+        for segment in manifest['segments']:
+            shard = segment['shard']
+            self.segments.append(ReplaySegment(segment['iteration'], segment['size'], shard=shard,
+                                               paths={column: self.shard_path(shard, column)
+                                                      for column in COLUMN_TYPES}))
+        self.next_shard = manifest['next_shard']
+        self.saved_paths = self.manifest_paths(manifest)
+        self.update_offsets()
+        return True
+
+    def manifest_paths(self, manifest):
+        # the files of all shards listed in a manifest
+        return {self.shard_path(segment['shard'], column) for segment in manifest['segments'] for column in COLUMN_TYPES}
+
+
+def aggregate_positions(action_size, boards, values, scalar_values, pi_offsets, pi_indices, pi_values, visits):
+    """
+    Merges the examples of the same position (equal board and scalar values).
+
+    Input:
+        visits: the number of root visits behind the policy of every example.
+                The searches differ in their visits (reused subtrees, timed
+                searches), so the policies are weighted by them
+
+    Returns:
+        (boards, values, scalar_values, counts, pi_offsets, pi_indices,
+         pi_values): the columns of the merged examples in the order of their
+                     first occurrence, with the mean value, the visit-weighted
+                     mean policy and the number of merged examples
+    """
+    n = len(values)
+    if n == 0:
+        return boards, values, scalar_values, np.zeros(0), pi_offsets, pi_indices, pi_values
+    keys = np.concatenate((boards.reshape(n, -1), scalar_values.astype(np.uint8)), axis=1)
+    _, first, inverse, counts = np.unique(keys, axis=0, return_index=True, return_inverse=True, return_counts=True)
+    # number the positions by their first occurrence
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    positions = rank[inverse.reshape(-1)]
+    first, counts = first[order], counts[order]
+    m = len(first)
+
+    values = np.bincount(positions, weights=values, minlength=m) / counts
+    position_visits = np.bincount(positions, weights=visits, minlength=m)
+    # sum the visit-weighted probabilities of every (position, action) pair, sorted by position and action
+    lengths = np.diff(pi_offsets)
+    entry_positions = np.repeat(positions, lengths)
+    pairs, pair_inverse = np.unique(entry_positions * action_size + np.asarray(pi_indices, dtype=np.int64),
+                                    return_inverse=True)
+    pair_positions = pairs // action_size
+    weighted_values = np.asarray(pi_values, dtype=np.float64) * np.repeat(visits, lengths)
+    pi_values = np.bincount(pair_inverse.reshape(-1), weights=weighted_values, minlength=len(pairs)) \
+        / position_visits[pair_positions]
+    pi_offsets = np.concatenate(([0], np.cumsum(np.bincount(pair_positions, minlength=m))))
+    return boards[first], values, scalar_values[first], counts, pi_offsets, pairs % action_size, pi_values
+
+
+class HistorySampler():
+    """
+    Draws the training examples of a ReplayBuffer by their global index, so
+    that the history is never copied into one list and shuffled.
+
+    With recency_decay < 1, an example of an iteration that is age iterations
+    older than the newest one is drawn recency_decay**age times as often as
+    an example of the newest iteration. The merged examples of an aggregating
+    buffer are drawn in proportion to count**count_exponent, i.e. as often as
+    the examples they replace with the default 1, or uniformly with 0.
+    """
+
+    def __init__(self, buffer, recency_decay=1.0, count_exponent=1.0):
+        self.buffer = buffer
+        self.recency_decay = recency_decay
+        self.count_exponent = count_exponent
+        self.cumulative_weights = {}    # segment -> cumulative sampling weights of its examples
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def sample_symmetries(self, batch_size):
+        """
+        Returns:
+            symmetries: a random symmetry for every example of a batch, or None
+                        if the buffer stores all symmetric forms itself
+        """
+        if self.buffer.symmetry_tables is None:
+            return None
+        return np.random.randint(len(self.buffer.symmetry_tables.board_indices), size=batch_size)
+
+    def sample(self, batch_size):
+        """
+        Returns:
+            indices: batch_size global example indices, drawn with replacement
+        """
+        self.forget_evicted_segments()
+        weighted = self.buffer.aggregate and self.count_exponent != 0
+        if not weighted and (self.recency_decay == 1 or self.buffer.num_iterations() <= 1):
+            return np.random.randint(len(self.buffer), size=batch_size)
+        offsets = self.buffer.offsets
+        sizes = np.diff(offsets)
+        totals = np.array([self.segment_weights(segment)[-1] if len(segment) else 0.
+                           for segment in self.buffer.segments]) if weighted else sizes
+        iterations = np.array([segment.iteration for segment in self.buffer.segments])
+        weights = totals * self.recency_decay ** (iterations.max() - iterations).astype(np.float64)
+        # first the segments by their total weight, then an example within each segment
+        segments = np.random.choice(len(sizes), size=batch_size, p=weights / weights.sum())
+        if not weighted:
+            return offsets[segments] + (np.random.random(batch_size) * sizes[segments]).astype(np.int64)
+        targets = np.random.random(batch_size) * totals[segments]
+        indices = np.empty(batch_size, dtype=np.int64)
+        for segment in np.unique(segments):
+            rows = segments == segment
+            local = np.searchsorted(self.segment_weights(self.buffer.segments[segment]), targets[rows], side='right')
+            indices[rows] = offsets[segment] + np.minimum(local, sizes[segment] - 1)
+        return indices
+
+    def segment_weights(self, segment):
+        if segment not in self.cumulative_weights:
+            counts = np.asarray(segment.columns['counts'], dtype=np.float64)
+            self.cumulative_weights[segment] = np.cumsum(counts ** self.count_exponent)
+        return self.cumulative_weights[segment]
+
+    def forget_evicted_segments(self):
+        # the sampler lives as long as the buffer, the weights of the evicted segments are dropped
+        if len(self.cumulative_weights) > self.buffer.num_iterations():
+            segments = set(self.buffer.segments)
+            self.cumulative_weights = {segment: weights for segment, weights in self.cumulative_weights.items()
+                                       if segment in segments}
+
+    def example_weights(self):
+        """
+        Returns:
+            weights: the relative probability of every example (by global
+                     index) to be drawn by sample()
+        """
+        if not self.buffer.segments:
+            return np.zeros(0)
+        iterations = np.array([segment.iteration for segment in self.buffer.segments])
+        recency = self.recency_decay ** (iterations.max() - iterations).astype(np.float64)
+        weights = np.repeat(recency, np.diff(self.buffer.offsets))
+        if self.buffer.aggregate and self.count_exponent != 0:
+            counts = np.concatenate([np.asarray(segment.columns['counts'], dtype=np.float64)
+                                     for segment in self.buffer.segments])
+            weights *= counts ** self.count_exponent
+        return weights
+
+    def importance_weights(self, indices):
+        """
+        Returns:
+            weights: the loss weights of the examples at indices, or None if
+                     the examples are drawn by their weights, i.e. need no
+                     correction (see PrioritizedReplay.py)
+        """
+        return None
+
+    def update_priorities(self, indices, losses):
+        """
+        Receives the training losses of the examples at indices, only used by
+        prioritized samplers.
+        """
+        pass
@@ -0,0 +1,211 @@
+import numpy as np
+
+
+class SearchTree():
+    """
+    Storage for the statistics of the MCTS tree.
+
+    Nodes are addressed by integer indices and looked up by the board key
+    returned by game.stringRepresentation. Instead of one entry per (s,a) pair
+    and a full action vector per node, every expanded node owns a contiguous
+    range of the child pools with one entry per legal action:
+
+        actions[first_child[node]:first_child[node] + num_children[node]]
+
+    and priors, child_visits, value_sums and child_nodes over the same range.
+    child_nodes links an edge to the node it leads to once a search went
+    through it, which is what compact() follows to find the subtree of a
+    new root.
+    """
+
+    def __init__(self, node_capacity=1024, child_capacity=16384):
+        self.node_index = {}    # board key -> node
+        self.keys = []          # node -> board key
+        self.num_nodes = 0
+        self.num_child_entries = 0
+
+        # per node
+        self.ended = np.zeros(node_capacity, dtype=np.float64)      # game.getGameEnded for the node
+        self.visits = np.zeros(node_capacity, dtype=np.int32)       # #times the node was visited
+        self.first_child = np.full(node_capacity, -1, dtype=np.int64)   # -1 as long as the node isn't expanded
+        self.num_children = np.zeros(node_capacity, dtype=np.int32)
+
+        # per child (= legal action of a node)
+        self.actions = np.zeros(child_capacity, dtype=np.int32)
+        self.priors = np.zeros(child_capacity, dtype=np.float32)        # initial policy (returned by neural net)
+        self.child_visits = np.zeros(child_capacity, dtype=np.int32)    # #times the edge was visited
+        self.value_sums = np.zeros(child_capacity, dtype=np.float32)    # sum of the values backed up through the edge
+        self.child_nodes = np.full(child_capacity, -1, dtype=np.int32)  # node the edge leads to, -1 if not searched yet
+
+    def __len__(self):
+        return self.num_nodes
+
+    def find(self, key):
+        """
+        Returns:
+            node: the node stored for key or None
+        """
+        return self.node_index.get(key)
+
+    def add(self, key, ended):
+        """
+        Adds an unexpanded node for key.
+
+        Returns:
+            node: the index of the new node
+        """
+        if self.num_nodes == len(self.visits):
+            capacity = 2 * len(self.visits)
+            self.ended = _resized(self.ended, capacity, 0)
+            self.visits = _resized(self.visits, capacity, 0)
+            self.first_child = _resized(self.first_child, capacity, -1)
+            self.num_children = _resized(self.num_children, capacity, 0)
+        node = self.num_nodes
+        self.num_nodes += 1
+        self.node_index[key] = node
+        self.keys.append(key)
+        self.ended[node] = ended
+        return node
+
+    def is_expanded(self, node):
+        return self.first_child[node] >= 0
+
+    def expand(self, node, actions, priors):
+        """
+        Stores the legal actions of node and their priors.
+        """
+        count = len(actions)
+        required = self.num_child_entries + count
+        if required > len(self.actions):
+            capacity = max(2 * len(self.actions), required)
+            self.actions = _resized(self.actions, capacity, 0)
+            self.priors = _resized(self.priors, capacity, 0)
+            self.child_visits = _resized(self.child_visits, capacity, 0)
+            self.value_sums = _resized(self.value_sums, capacity, 0)
+            self.child_nodes = _resized(self.child_nodes, capacity, -1)
+        first = self.num_child_entries
+        self.actions[first:required] = actions
+        self.priors[first:required] = priors
+        self.first_child[node] = first
+        self.num_children[node] = count
+        self.num_child_entries = required
+
+    def children(self, node):
+        """
+        Returns:
+            (start, end): the range of the child pools owned by node
+        """
+        start = self.first_child[node]
+        return start, start + self.num_children[node]
+
+    def backup(self, node, child, value):
+        """
+        Adds one visit with value to the edge child (an index into the child
+        pools) of node.
+        """
+        self.visits[node] += 1
+        self.child_visits[child] += 1
+        self.value_sums[child] += value
+
+    def apply_virtual_loss(self, node, child, amount):
+        """
+        Counts amount visits with a lost value (-1 for the player to move at
+        node) for the edge child of node. A negative amount reverts it.
+        """
+        self.visits[node] += amount
+        self.child_visits[child] += amount
+        self.value_sums[child] -= amount
+
+    def link(self, child, node):
+        """
+        Records that the edge child leads to node.
+        """
+        self.child_nodes[child] = node
+
+    def compact(self, root):
+        """
+        Keeps only root and the nodes reachable from it (with their
+        statistics) and releases the rest of the tree. root becomes node 0,
+        the other nodes are renumbered in breadth first order.
+        """
+        order = [root]
+        new_nodes = {root: 0}
+        i = 0
+        while i < len(order):
+            node = order[i]
+            i += 1
+            if self.first_child[node] >= 0:
+                start, end = self.children(node)
+                for child_node in self.child_nodes[start:end].tolist():
+                    if child_node >= 0 and child_node not in new_nodes:
+                        new_nodes[child_node] = len(order)
+                        order.append(child_node)
+
+        old_nodes = np.array(order, dtype=np.int64)
+        remap = np.full(self.num_nodes, -1, dtype=np.int32)
+        remap[old_nodes] = np.arange(len(old_nodes), dtype=np.int32)
+
+        # the child ranges of the kept nodes, packed in the new order
+        first_child = self.first_child[old_nodes]
+        num_children = self.num_children[old_nodes]
+        expanded = first_child >= 0
+        lengths = num_children[expanded]
+        offsets = np.cumsum(lengths) - lengths
+        children = np.repeat(first_child[expanded] - offsets, lengths) + np.arange(lengths.sum())
+        new_first_child = np.full(len(old_nodes), -1, dtype=np.int64)
+        new_first_child[expanded] = offsets
+        child_nodes = self.child_nodes[children]
+        child_nodes = np.where(child_nodes >= 0, remap[child_nodes], -1)
+
+        self.keys = [self.keys[node] for node in order]
+        self.node_index = {key: node for node, key in enumerate(self.keys)}
+        self.num_nodes = len(order)
+        self.num_child_entries = len(children)
+        self.ended = _packed(self.ended, self.ended[old_nodes], 0)
+        self.visits = _packed(self.visits, self.visits[old_nodes], 0)
+        self.first_child = _packed(self.first_child, new_first_child, -1)
+        self.num_children = _packed(self.num_children, num_children, 0)
+        self.actions = _packed(self.actions, self.actions[children], 0)
+        self.priors = _packed(self.priors, self.priors[children], 0)
+        self.child_visits = _packed(self.child_visits, self.child_visits[children], 0)
+        self.value_sums = _packed(self.value_sums, self.value_sums[children], 0)
+        self.child_nodes = _packed(self.child_nodes, child_nodes, -1)
+
+    def action_counts(self, node, action_size):
+        """
+        Returns:
+            counts: a vector of length action_size with the visit counts of the
+                    actions taken at node
+        """
+        counts = np.zeros(action_size, dtype=np.int32)
+        if node is not None and self.is_expanded(node):
+            start, end = self.children(node)
+            counts[self.actions[start:end]] = self.child_visits[start:end]
+        return counts
+
+    def action_visits(self, node):
+        """
+        Returns:
+            (actions, visits): the actions taken at node at least once, in
+                               ascending order, and their visit counts
+        """
+        if node is None or not self.is_expanded(node):
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        start, end = self.children(node)
+        visited = self.child_visits[start:end] > 0
+        actions = self.actions[start:end][visited]
+        order = np.argsort(actions, kind='stable')
+        return actions[order], self.child_visits[start:end][visited][order]
+
+
+def _resized(array, capacity, fill):
+    result = np.full(capacity, fill, dtype=array.dtype)
+    result[:len(array)] = array
+    return result
+
+
+def _packed(array, values, fill):
+    # array of the capacity of array that starts with values
+    result = np.full(len(array), fill, dtype=array.dtype)
+    result[:len(values)] = values
+    return result
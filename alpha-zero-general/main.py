@@ -6,15 +6,25 @@ from utils import dotdict
 args = dotdict({
     'numIters': 1000,
     'numEps': 100,           # 200
+    'numSelfPlayWorkers': 1,    # processes playing the self-play episodes in parallel
+    'inference_server': False,  # evaluate the boards of all self-play workers in one server process (InferenceServer.py)
+    'inference_max_batch_size': 64,
+    'inference_max_wait': 0.002,    # seconds the server waits for more requests to fill a batch
     'tempThreshold': 15,    # 700
     'updateThreshold': 0.57,
     'maxlenOfQueue': 200000,
     'numMCTSSims': 800,      # 900
+    'mcts_batch_size': 1,   # number of MCTS leaves evaluated together by the neural networks
+    'reuse_tree': True,     # keep the subtree of the position reached by the move played for the next search
+    'evaluation_cache_mb': 256,     # memory of the network evaluations kept across episodes (0 disables the cache)
     'arenaCompare': 50,     # 100
+    'numArenaWorkers': 1,   # processes playing the arena games in parallel
     'cpuct': 1,
     'prune': True,
     'prune_starting_prob': 0.75,
     'prune_prob_gain_per_iteration': 0.05,
+    'bitboard': False,      # use the bitmask board backend (tafl/TaflBitBoard.py)
+    'debug_actions': False,     # check every conversion between action indices and moves (tafl/ActionCodec.py)
 
     'checkpoint': './temp/',
     'load_model': True,
@@ -23,6 +33,13 @@ args = dotdict({
     'load_folder_file_white': ('./temp/', 'best_white.pth.tar'),
     'load_folder_file_black': ('./temp/', 'best_black.pth.tar'),
     'numItersForTrainExamplesHistory': 20,
+    'store_symmetries': True,   # store all 8 symmetric forms of every example, otherwise a random one is applied when sampled
+    'aggregate_positions': False,   # merge the examples of the same position within an iteration (visit-weighted pi, mean v, count)
+    'aggregate_count_exponent': 1.0,    # merged examples are drawn count**exponent as often (1: as often as unmerged)
+    'history_recency_decay': 1.0,   # examples of older iterations are drawn history_recency_decay**age as often
+    'prioritized_replay': False,    # draw the examples in proportion to their last training loss (PrioritizedReplay.py)
+    'priority_alpha': 0.6,          # priority = loss**alpha, 0 draws uniformly
+    'priority_beta': 0.4,           # strength of the importance weights that correct the loss for the prioritization
 
     'train_both': True,
     'train_black_first': False,
@@ -35,7 +52,7 @@ args = dotdict({
 
 if __name__=="__main__":
     #  g = OthelloGame(6)
-    g = TaflGame(7, args.prune)
+    g = TaflGame(7, args.prune, args.bitboard, args.debug_actions)
     white_nnet = nn(g)
     black_nnet = nn(g)
 
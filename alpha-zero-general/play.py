@@ -11,6 +11,14 @@ def get_player(time):
     black_nnet = nn(g)
     white_nnet.load_checkpoint('./tafl_model_1/', 'white.pth.tar')
     black_nnet.load_checkpoint('./tafl_model_1/', 'white.pth.tar')
-    args = dotdict({'numMCTSSims': 10000, 'cpuct': 1.1})
+    args = dotdict({'numMCTSSims': 10000, 'cpuct': 1.1, 'mcts_batch_size': 1, 'reuse_tree': True})
     mcts = MCTS(g, white_nnet, black_nnet, args)
-    return lambda board, turn_player: np.argmax(mcts.getActionProb(board, turn_player, temp=0, time=time))
+
+    def play(board, turn_player):
+        action = np.argmax(mcts.getActionProb(board, turn_player, temp=0, time_budget=time))
+        # search on the opponent's time, the tree of the position they choose is reused for the next move
+        next_board, next_player = g.getNextState(board, turn_player, action, copy_board=True)
+        mcts.start_pondering(next_board, next_player)
+        return action
+
+    return play
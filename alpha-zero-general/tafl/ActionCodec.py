@@ -0,0 +1,113 @@
+import numpy as np
+
+
+class ActionCodec:
+    """
+    Conversion between the action indices of TaflGame and explicit moves ((x_from, y_from), (x_to, y_to)) (with
+    border) for one board size, using lookup tables that are built once:
+
+        explicit[index]: the move of an action index as a tuple of ints
+        indices[move]: the action index of a move
+        from_x, from_y, to_x, to_y, movement_type: the decoded moves as arrays, by action index
+        index_table[x_from, y_from, x_to, y_to]: the action index of a move or -1, for whole arrays of moves
+
+    The index is (((x_from - 1) * size + y_from - 1) * size + to - 1) * 2 + movement_type, where "to" is x_to for
+    horizontal and y_to for vertical movement. The last index (size * size * size * 2) means that the player has no
+    moves left and isn't covered by the tables.
+
+    With debug set, every conversion checks that converting back gives the original action again.
+    """
+
+    def __init__(self, size, debug=False):
+        self.size = size
+        self.debug = debug
+        self.action_size = size * size * size * 2
+
+        x_from, y_from, to, movement_type = np.unravel_index(np.arange(self.action_size), (size, size, size, 2))
+        horizontal = movement_type == 0
+        # all coordinates + 1 because of the border
+        self.from_x = x_from + 1
+        self.from_y = y_from + 1
+        self.to_x = np.where(horizontal, to, x_from) + 1
+        self.to_y = np.where(horizontal, y_from, to) + 1
+        self.movement_type = movement_type
+
+        self.explicit = list(zip(zip(self.from_x.tolist(), self.from_y.tolist()),
+                                 zip(self.to_x.tolist(), self.to_y.tolist())))
+        self.indices = {}
+        self.index_table = np.full((size + 2,) * 4, -1, dtype=np.intp)
+        for index, (move, movement_type) in enumerate(zip(self.explicit, self.movement_type.tolist())):
+            # a piece that doesn't move has a horizontal and a vertical index, the horizontal one is used
+            if move[0] != move[1] or movement_type == 0:
+                self.indices[move] = index
+                (x_from, y_from), (x_to, y_to) = move
+                self.index_table[x_from, y_from, x_to, y_to] = index
+
+    def encode(self, move):
+        """
+        Input:
+            move: ((x_from, y_from), (x_to, y_to))
+
+        Returns:
+            index: the action index of move
+        """
+        index = self.indices[move]
+        if self.debug:
+            assert 0 <= index < self.action_size
+            assert self.explicit[index] == move, str(move) + " is encoded as " + str(index)
+        return index
+
+    def decode(self, index):
+        """
+        Input:
+            index: action index (not the last one)
+
+        Returns:
+            move: ((x_from, y_from), (x_to, y_to))
+        """
+        move = self.explicit[index]
+        if self.debug:
+            assert self.encode(move) == index, str(index) + " is decoded as " + str(move)
+        return move
+
+    def encode_moves(self, moves):
+        """
+        Input:
+            moves: list of moves ((x_from, y_from), (x_to, y_to))
+
+        Returns:
+            indices: array with the action index of every move
+        """
+        if len(moves) == 0:
+            return np.zeros(0, dtype=np.intp)
+        moves = np.asarray(moves, dtype=np.intp)
+        indices = self.index_table[moves[:, 0, 0], moves[:, 0, 1], moves[:, 1, 0], moves[:, 1, 1]]
+        if self.debug:
+            assert np.all(indices >= 0), "invalid moves: " + str(moves[indices < 0].tolist())
+            assert np.array_equal(self.decode_indices(indices), moves)
+        return indices
+
+    def decode_indices(self, indices):
+        """
+        Input:
+            indices: array of action indices (not the last one)
+
+        Returns:
+            moves: array of shape (n, 2, 2) with the moves [[x_from, y_from], [x_to, y_to]]
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        moves = np.stack((np.stack((self.from_x[indices], self.from_y[indices]), axis=-1),
+                          np.stack((self.to_x[indices], self.to_y[indices]), axis=-1)), axis=-2)
+        if self.debug:
+            assert np.array_equal(self.index_table[moves[:, 0, 0], moves[:, 0, 1], moves[:, 1, 0], moves[:, 1, 1]],
+                                  indices)
+        return moves
+
+
+_codecs = {}
+
+
+def get_action_codec(size, debug=False):
+    if (size, debug) not in _codecs:
+        _codecs[(size, debug)] = ActionCodec(size, debug)
+    return _codecs[(size, debug)]
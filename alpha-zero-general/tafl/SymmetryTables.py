@@ -0,0 +1,143 @@
+import numpy as np
+
+from tafl.ActionCodec import get_action_codec
+
+
+# The 8 symmetries of the board in the order of TaflGame.getSymmetries, as functions of the 0-based coordinates
+# (x, y) with m = size - 1. The last four swap the axes, i.e. turn horizontal moves into vertical ones and vice versa
+def _symmetries(m):
+    return (
+        lambda x, y: (x, y),                # original
+        lambda x, y: (m - x, y),            # horizontal flip
+        lambda x, y: (m - x, m - y),        # horizontal and vertical flip
+        lambda x, y: (x, m - y),            # vertical flip
+        lambda x, y: (m - y, x),            # rotation
+        lambda x, y: (y, x),                # rotation and horizontal flip
+        lambda x, y: (y, m - x),            # rotation and horizontal and vertical flip
+        lambda x, y: (m - y, m - x),        # rotation and vertical flip
+    )
+
+
+NUMBER_OF_SYMMETRIES = 8
+
+
+class SymmetryTables:
+    """
+    Index permutations of all 8 symmetries for one board size, so that a board, a policy vector or a king position
+    is transformed with a single fancy-indexing operation:
+
+        board_indices[k]: symmetric_board.flat = board.flat[board_indices[k]] (board without the border)
+        action_indices[k]: symmetric_pi = pi[action_indices[k]]
+        action_targets[k]: the inverse permutation, the action a becomes action_targets[k, a] (for sparse policies)
+        king_positions[k, x, y]: the position of the king at (x, y) (with border) in symmetry k
+    """
+
+    def __init__(self, size):
+        self.size = size
+        m = size - 1
+        symmetries = _symmetries(m)
+
+        x, y = np.divmod(np.arange(size * size), size)
+        # every action index decoded by the action codec, but 0-based
+        codec = get_action_codec(size)
+        action_size = codec.action_size
+        x_from, y_from = codec.from_x - 1, codec.from_y - 1
+        x_to, y_to = codec.to_x - 1, codec.to_y - 1
+        movement_type = codec.movement_type
+
+        self.board_indices = np.empty((NUMBER_OF_SYMMETRIES, size * size), dtype=np.intp)
+        # the last index (no action left) is the same in every symmetry
+        self.action_indices = np.full((NUMBER_OF_SYMMETRIES, action_size + 1), action_size, dtype=np.intp)
+        self.king_positions = np.zeros((NUMBER_OF_SYMMETRIES, size + 2, size + 2, 2), dtype=np.intp)
+        for k, symmetry in enumerate(symmetries):
+            # the tile (x, y) moves to (new_x, new_y), i.e. the new tile takes its state from (x, y)
+            new_x, new_y = symmetry(x, y)
+            self.board_indices[k, new_x * size + new_y] = x * size + y
+
+            new_x_from, new_y_from = symmetry(x_from, y_from)
+            new_x_to, new_y_to = symmetry(x_to, y_to)
+            # the movement type is flipped instead of derived from the coordinates, so that the indices of the
+            # pieces that don't move are permuted as well
+            new_movement_type = movement_type ^ 1 if k >= 4 else movement_type
+            new_to = np.where(new_movement_type == 0, new_x_to, new_y_to)
+            new_action = ((new_x_from * size + new_y_from) * size + new_to) * 2 + new_movement_type
+            self.action_indices[k, new_action] = np.arange(action_size)
+
+            king_x, king_y = symmetry(x, y)
+            self.king_positions[k, x + 1, y + 1, 0] = king_x + 1
+            self.king_positions[k, x + 1, y + 1, 1] = king_y + 1
+
+        self.action_targets = np.empty_like(self.action_indices)
+        self.action_targets[np.arange(NUMBER_OF_SYMMETRIES)[:, None], self.action_indices] = np.arange(action_size + 1)
+
+    def transform(self, board, pi, king_position):
+        """
+        Input:
+            board: size x size array of TileStates (without the border)
+            pi: policy vector
+            king_position: (x, y) with border
+
+        Returns:
+            (boards, pis, king_positions): the 8 symmetric forms stacked along the first axis
+        """
+        size = self.size
+        boards = board.reshape(size * size)[self.board_indices].reshape(NUMBER_OF_SYMMETRIES, size, size)
+        pis = np.asarray(pi)[self.action_indices]
+        king_x, king_y = king_position
+        return boards, pis, self.king_positions[:, int(king_x), int(king_y)]
+
+    def transform_batch(self, boards, pis, king_positions):
+        """
+        Input:
+            boards: array of shape (n, size, size) without the border
+            pis: array of shape (n, action_size)
+            king_positions: array of shape (n, 2) with border
+
+        Returns:
+            (boards, pis, king_positions): arrays with 8 * n entries, the 8 symmetric forms of every example in a row
+        """
+        boards, king_positions = self.transform_boards(boards, king_positions)
+        pis = np.asarray(pis)[:, self.action_indices].reshape(len(boards), -1)
+        return boards, pis, king_positions
+
+    def transform_sparse_batch(self, boards, pis, king_positions):
+        """
+        Input:
+            boards: array of shape (n, size, size) without the border
+            pis: list of n sparse policies (indices, probs)
+            king_positions: array of shape (n, 2) with border
+
+        Returns:
+            (boards, pis, king_positions): like transform_batch, but with a list
+                                           of 8 * n sparse policies. The probs
+                                           of the symmetric forms are the same
+                                           arrays, only the indices are mapped
+        """
+        boards, king_positions = self.transform_boards(boards, king_positions)
+        lengths = [len(indices) for indices, _ in pis]
+        offsets = np.cumsum([0] + lengths)
+        indices = np.concatenate([indices for indices, _ in pis]) if pis else np.zeros(0, dtype=np.intp)
+        # the indices of all policies in all symmetries with a single gather, shape (8, number of indices)
+        indices = self.action_targets[:, np.asarray(indices, dtype=np.intp)]
+        symmetric_pis = [(indices[k, offsets[i]:offsets[i + 1]], probs)
+                         for i, (_, probs) in enumerate(pis) for k in range(NUMBER_OF_SYMMETRIES)]
+        return boards, symmetric_pis, king_positions
+
+    def transform_boards(self, boards, king_positions):
+        # the boards and king positions of transform_batch
+        size = self.size
+        n = len(boards)
+        boards = np.asarray(boards).reshape(n, size * size)[:, self.board_indices].reshape(n * NUMBER_OF_SYMMETRIES,
+                                                                                             size, size)
+        king_positions = np.asarray(king_positions, dtype=np.intp).reshape(n, 2)
+        king_positions = self.king_positions[:, king_positions[:, 0], king_positions[:, 1]]
+        return boards, king_positions.transpose(1, 0, 2).reshape(n * NUMBER_OF_SYMMETRIES, 2)
+
+
+_tables = {}
+
+
+def get_symmetry_tables(size):
+    if size not in _tables:
+        _tables[size] = SymmetryTables(size)
+    return _tables[size]
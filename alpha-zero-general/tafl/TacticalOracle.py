@@ -0,0 +1,266 @@
+from tafl.TaflBoard import Player, TileState
+
+# plain ints, the enum attribute lookups are too slow for the inner loops
+EMPTY = int(TileState.empty)
+WHITE = int(TileState.white)
+BLACK = int(TileState.black)
+KING = int(TileState.king)
+THRONE = int(TileState.throne)
+CORNER = int(TileState.corner)
+PIECES = WHITE | BLACK | KING
+
+DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+class TacticalOracle():
+    """
+    Decides for every move of the turn player in one position whether the
+    opponent can win right after it, i.e. the same as
+    TaflGame.would_next_board_lead_to_opponent_winning, without making the
+    move on the board and generating all moves of the opponent for it:
+
+        black moves: can the king make an escape move (get_king_escape_move)?
+        white moves: can a black piece move to a square that captures the king
+                     (get_king_capture_move)?
+
+    The threat of the unchanged position is computed once in the constructor,
+    together with the squares it depends on: the lines of the king for the
+    escape moves, the squares around the king and the lines of the squares
+    black would have to reach for a capture. A move that doesn't touch any of
+    them (with the pieces it captures) keeps that threat. For all other moves
+    the threat is evaluated again on a copy of the tiles with only the move
+    applied, which only walks the lines from the king or the capture squares.
+
+    Moves that repeat a position for the third time are not considered, they
+    are taken as winning moves before the remaining moves are classified.
+    """
+
+    def __init__(self, board, turn_player):
+        self.size = board.size
+        self.turn_player = turn_player
+        self.tiles = board.board.tolist()
+        self.king_position = (int(board.king_position[0]), int(board.king_position[1]))
+        if turn_player == Player.black:
+            self.own = BLACK
+            self.opponent = WHITE
+            self.threat = self.escape_possible(self.king_position)
+            self.relevant = self.escape_squares(self.king_position)
+        else:
+            self.own = WHITE | KING
+            self.opponent = BLACK
+            self.threat = self.capture_possible(self.king_position)
+            self.relevant = self.capture_squares(self.king_position)
+
+    def is_losing_move(self, move):
+        """
+        Returns:
+            losing: True if the opponent can win the game after move (or if the
+                    move itself ends the game with a win of the opponent)
+        """
+        t = self.tiles
+        (x_from, y_from), (x_to, y_to) = move
+        from_tile = t[x_from][y_from]
+        to_tile = t[x_to][y_to]
+        piece = from_tile & PIECES
+        moves_king = piece & KING != 0
+        if moves_king and to_tile == CORNER:
+            # the king escapes
+            return False
+
+        t[x_to][y_to] = (to_tile & THRONE) | piece
+        t[x_from][y_from] = from_tile & ~PIECES
+        king_position = (x_to, y_to) if moves_king else self.king_position
+        captured, king_captured = self.captures(x_to, y_to, king_position)
+        for x, y in captured:
+            t[x][y] = EMPTY
+
+        if king_captured:
+            losing = self.turn_player == Player.white
+        elif not moves_king and (x_from, y_from) not in self.relevant and (x_to, y_to) not in self.relevant \
+                and not any(position in self.relevant for position in captured):
+            losing = self.threat
+        elif self.turn_player == Player.black:
+            losing = self.escape_possible(king_position)
+        else:
+            losing = self.capture_possible(king_position)
+
+        for x, y in captured:
+            t[x][y] = self.opponent
+        t[x_from][y_from] = from_tile
+        t[x_to][y_to] = to_tile
+        return losing
+
+    def captures(self, x, y, king_position):
+        """
+        Same rules as TaflBoard.capture for a piece of the turn player that
+        has just moved to (x, y).
+
+        Returns:
+            captured: the captured pawns of the opponent
+            king_captured: True if the king is captured
+        """
+        t = self.tiles
+        throne_check = EMPTY if t[king_position[0]][king_position[1]] & THRONE != 0 else THRONE
+        hostile = self.own | CORNER | throne_check
+        captured = []
+        for dx, dy in DIRECTIONS:
+            if t[x + dx][y + dy] & self.opponent != 0 and t[x + 2 * dx][y + 2 * dy] & hostile != 0:
+                captured.append((x + dx, y + dy))
+
+        king_captured = False
+        for dx, dy in DIRECTIONS:
+            if t[x + dx][y + dy] & KING != 0 and t[x + 2 * dx][y + 2 * dy] & (self.own | THRONE) != 0:
+                # the captured pawns are already gone when TaflBoard.capture checks the king
+                for position_x, position_y in captured:
+                    t[position_x][position_y] = EMPTY
+                king_x, king_y = king_position
+                if (t[king_x][king_y] | t[king_x + 1][king_y] | t[king_x - 1][king_y] |
+                        t[king_x][king_y + 1] | t[king_x][king_y - 1]) & THRONE != 0:
+                    king_captured = all(t[king_x + kx][king_y + ky] & (BLACK | THRONE) != 0 for kx, ky in DIRECTIONS)
+                else:
+                    king_captured = t[king_x + 1][king_y] & BLACK != 0 and t[king_x - 1][king_y] & BLACK != 0 \
+                        or t[king_x][king_y + 1] & BLACK != 0 and t[king_x][king_y - 1] & BLACK != 0
+                for position_x, position_y in captured:
+                    t[position_x][position_y] = self.opponent
+                break
+        return captured, king_captured
+
+    def king_targets(self, king_position):
+        """
+        Returns:
+            targets: the squares the king can move to (see
+                     TaflBoard.get_valid_actions_for_piece)
+        """
+        t = self.tiles
+        king_x, king_y = king_position
+        # the king moves like a pawn while it stands on the throne
+        is_king = t[king_x][king_y] == KING
+        targets = set()
+        for dx, dy in DIRECTIONS:
+            x = king_x + dx
+            y = king_y + dy
+            while True:
+                tile = t[x][y]
+                if tile == EMPTY or is_king and tile & (CORNER | THRONE) != 0:
+                    targets.add((x, y))
+                elif tile != THRONE:
+                    break
+                x += dx
+                y += dy
+        return targets
+
+    def escape_possible(self, king_position):
+        """
+        Returns:
+            possible: True if get_king_escape_move would find a move, that is
+                      if the king can reach the edge in a straight line or one
+                      of the squares diagonal to the corners under the
+                      conditions checked there
+        """
+        t = self.tiles
+        size = self.size
+        king_x, king_y = king_position
+        targets = self.king_targets(king_position)
+        if (1, king_y) in targets or (size, king_y) in targets or (king_x, 1) in targets or (king_x, size) in targets:
+            return True
+
+        if not any(square in targets for square in self.diagonal_squares()):
+            return False
+        no_black_top = all(t[1][y] & BLACK == 0 for y in range(3, size - 1))
+        no_black_bottom = all(t[size][y] & BLACK == 0 for y in range(3, size - 1))
+        no_black_left = all(t[x][1] & BLACK == 0 for x in range(3, size - 1))
+        no_black_right = all(t[x][size] & BLACK == 0 for x in range(3, size - 1))
+        return (2, 2) in targets and t[1][2] | t[2][1] == EMPTY \
+            and (no_black_top or t[3][2] != BLACK) and (no_black_left or t[2][3] != BLACK) \
+            or (size - 1, 2) in targets and t[size][2] | t[size - 1][1] == EMPTY \
+            and (no_black_bottom or t[size - 2][2] != BLACK) and (no_black_left or t[size - 1][3] != BLACK) \
+            or (2, size - 1) in targets and t[1][size - 1] | t[2][size] == EMPTY \
+            and (no_black_top or t[2][size - 2] != BLACK) and (no_black_right or t[3][size - 1] != BLACK) \
+            or (size - 1, size - 1) in targets and t[size][size - 1] | t[size - 1][size] == EMPTY \
+            and (no_black_bottom or t[size - 2][size - 1] != BLACK) and (no_black_right or t[size - 1][size - 2] != BLACK)
+
+    def diagonal_squares(self):
+        size = self.size
+        return (2, 2), (size - 1, 2), (2, size - 1), (size - 1, size - 1)
+
+    def escape_squares(self, king_position):
+        """
+        Returns:
+            squares: the squares escape_possible depends on for a king that
+                     doesn't move
+        """
+        size = self.size
+        king_x, king_y = king_position
+        squares = {(king_x, y) for y in range(1, size + 1)} | {(x, king_y) for x in range(1, size + 1)}
+        if any(square in self.king_targets(king_position) for square in self.diagonal_squares()):
+            # the conditions of the squares diagonal to the corners
+            for line in range(1, size + 1):
+                squares |= {(1, line), (size, line), (line, 1), (line, size)}
+            squares |= {(3, 2), (2, 3), (size - 2, 2), (size - 1, 3), (2, size - 2), (3, size - 1),
+                        (size - 2, size - 1), (size - 1, size - 2)}
+        return squares
+
+    def capture_positions(self, king_position):
+        """
+        Returns:
+            positions: the squares a black piece has to move to in order to
+                       capture the king (see get_king_capture_move)
+        """
+        t = self.tiles
+        king_x, king_y = king_position
+        positions = []
+        # check if king is on or next to throne
+        if (t[king_x][king_y] | t[king_x + 1][king_y] | t[king_x - 1][king_y] |
+                t[king_x][king_y + 1] | t[king_x][king_y - 1]) & THRONE != 0:
+            for x, y in ((king_x + 1, king_y), (king_x - 1, king_y), (king_x, king_y + 1), (king_x, king_y - 1)):
+                if t[x][y] & (BLACK | THRONE) == 0:
+                    if positions:
+                        # at least two spots are empty, so no capture possible
+                        return []
+                    positions.append((x, y))
+        else:
+            if t[king_x + 1][king_y] == BLACK and t[king_x - 1][king_y] == EMPTY:
+                positions.append((king_x - 1, king_y))
+            elif t[king_x - 1][king_y] == BLACK and t[king_x + 1][king_y] == EMPTY:
+                positions.append((king_x + 1, king_y))
+            if t[king_x][king_y + 1] == BLACK and t[king_x][king_y - 1] == EMPTY:
+                positions.append((king_x, king_y - 1))
+            elif t[king_x][king_y - 1] == BLACK and t[king_x][king_y + 1] == EMPTY:
+                positions.append((king_x, king_y + 1))
+        return positions
+
+    def black_can_reach(self, position):
+        # a black pawn can move to position if it is the first piece on one of its lines (pawns pass the empty throne)
+        t = self.tiles
+        x, y = position
+        if t[x][y] != EMPTY:
+            return False
+        for dx, dy in DIRECTIONS:
+            other_x = x + dx
+            other_y = y + dy
+            while t[other_x][other_y] == EMPTY or t[other_x][other_y] == THRONE:
+                other_x += dx
+                other_y += dy
+            if t[other_x][other_y] == BLACK:
+                return True
+        return False
+
+    def capture_possible(self, king_position):
+        """
+        Returns:
+            possible: True if black can capture the king with its next move
+        """
+        return any(self.black_can_reach(position) for position in self.capture_positions(king_position))
+
+    def capture_squares(self, king_position):
+        """
+        Returns:
+            squares: the squares capture_possible depends on for a king that
+                     doesn't move
+        """
+        size = self.size
+        king_x, king_y = king_position
+        squares = {king_position} | {(king_x + dx, king_y + dy) for dx, dy in DIRECTIONS}
+        for x, y in self.capture_positions(king_position):
+            squares |= {(x, line) for line in range(1, size + 1)} | {(line, y) for line in range(1, size + 1)}
+        return squares
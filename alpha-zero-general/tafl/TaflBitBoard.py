@@ -0,0 +1,441 @@
+import numpy as np
+
+from tafl.TaflBoard import Outcome, PIECES, Player, TileState, ZOBRIST_REPETITION_KEYS, ZOBRIST_TILE_KEYS, \
+    ZOBRIST_WHITE_TO_MOVE
+
+
+# Tiles are indexed on the padded (size + 2) x (size + 2) grid of TaflBoard, so that the square (x, y) is the bit
+# x * (size + 2) + y of a mask. Because of the padding, walking off the board always runs into the border mask.
+class BitBoardTables:
+
+    def __init__(self, size):
+        self.size = size
+        self.width = size + 2
+        width = self.width
+
+        # (x, y) coordinates of every bit index
+        self.coordinates = [divmod(index, width) for index in range(width * width)]
+
+        self.border = 0
+        for index, (x, y) in enumerate(self.coordinates):
+            if x == 0 or y == 0 or x == size + 1 or y == size + 1:
+                self.border |= 1 << index
+        self.corners = self.bit((1, 1)) | self.bit((1, size)) | self.bit((size, 1)) | self.bit((size, size))
+        self.throne = self.bit(((size + 1) // 2, (size + 1) // 2))
+        self.all_tiles = (1 << (width * width)) - 1
+
+        # Zobrist keys (see TaflBoard) of a white piece, a black piece and the king by bit index
+        self.zobrist_white = [ZOBRIST_TILE_KEYS[TileState.white][x][y] for x, y in self.coordinates]
+        self.zobrist_black = [ZOBRIST_TILE_KEYS[TileState.black][x][y] for x, y in self.coordinates]
+        self.zobrist_king = [ZOBRIST_TILE_KEYS[TileState.king][x][y] for x, y in self.coordinates]
+
+        # rays[direction][index] holds all tiles from index (exclusive) in direction up to and including the border
+        # directions are in the order in which TaflBoard generates moves: up, down, left, right
+        self.steps = (-width, width, -1, 1)
+        self.rays = []
+        for step in self.steps:
+            rays = []
+            for index, (x, y) in enumerate(self.coordinates):
+                ray = 0
+                if not self.border & (1 << index):
+                    other = index + step
+                    while True:
+                        ray |= 1 << other
+                        if self.border & (1 << other):
+                            break
+                        other += step
+                rays.append(ray)
+            self.rays.append(rays)
+
+    def bit(self, position):
+        x, y = position
+        # positions decoded from action indices hold numpy integers
+        return 1 << int(x * self.width + y)
+
+
+_tables = {}
+
+
+def get_tables(size):
+    if size not in _tables:
+        _tables[size] = BitBoardTables(size)
+    return _tables[size]
+
+
+# yields the indices of all set bits of mask, starting with the lowest
+def iterate_bits(mask):
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+# yields the indices of all set bits of mask, starting with the highest
+def iterate_bits_reversed(mask):
+    while mask:
+        index = mask.bit_length() - 1
+        yield index
+        mask ^= 1 << index
+
+
+class TaflBitBoard:
+    """
+    Drop-in replacement for TaflBoard that stores the piece placement as integer bitmasks (one for the black pieces,
+    the white pieces and the king, plus constant masks for the throne, the corners and the border). Move generation
+    and captures are done with mask operations, which is considerably faster than walking the numpy array.
+
+    The numpy representation is still available via the board property for code that reads single tiles
+    (e.g. the neural network input or the move heuristics in TaflGame).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.tables = get_tables(size)
+
+        self.black = 0
+        self.white = 0
+        self.king = 0
+        self.king_position = ((self.size + 1) // 2, (self.size + 1) // 2)
+        self.zobrist_hash = 0
+        self.board_states_dict = {}
+        self.outcome = Outcome.ongoing
+        self.white_pieces = 0
+        self.black_pieces = 0
+
+        # see TaflBoard
+        self.print_to_console = False
+        self.print_game_over_reason = False
+
+        self._board_cache = None
+
+        # see TaflBoard.push()
+        self.undo_stack = []
+
+        self.reset_board()
+
+    def reset_board(self):
+        bit = self.tables.bit
+        self.black = 0
+        self.white = 0
+
+        if self.size == 11:
+            black = [(1, y) for y in range(4, 9)] + [(2, 6)] + [(11, y) for y in range(4, 9)] + [(10, 6)] \
+                    + [(x, 1) for x in range(4, 9)] + [(6, 2)] + [(x, 11) for x in range(4, 9)] + [(6, 10)]
+            white = [(x, y) for x in range(5, 8) for y in range(5, 8) if (x, y) != (6, 6)] \
+                    + [(4, 6), (6, 8), (6, 4), (8, 6)]
+        elif self.size == 7:
+            black = [(1, 4), (2, 4), (4, 1), (4, 2), (4, 6), (4, 7), (6, 4), (7, 4)]
+            white = [(3, 4), (4, 3), (4, 5), (5, 4)]
+        elif self.size == 9:
+            black = [(1, y) for y in range(4, 7)] + [(2, 5)] + [(9, y) for y in range(4, 7)] + [(8, 5)] \
+                    + [(x, 1) for x in range(4, 7)] + [(5, 2)] + [(x, 9) for x in range(4, 7)] + [(5, 8)]
+            white = [(3, 5), (4, 5), (5, 3), (5, 4), (5, 6), (5, 7), (6, 5), (7, 5)]
+        else:
+            raise NotImplementedError
+
+        for position in black:
+            self.black |= bit(position)
+        for position in white:
+            self.white |= bit(position)
+        self.king_position = ((self.size + 1) // 2, (self.size + 1) // 2)
+        self.king = bit(self.king_position)
+
+        self.white_pieces = len(white) + 1
+        self.black_pieces = len(black)
+
+        self._board_cache = None
+        self.zobrist_hash = self.compute_zobrist_hash()
+        self.board_states_dict = {self.zobrist_hash: 1}
+        self.outcome = Outcome.ongoing
+        self.undo_stack = []
+
+    # see TaflBoard.compute_zobrist_hash()
+    def compute_zobrist_hash(self):
+        tables = self.tables
+        zobrist_hash = 0
+        for mask, keys in ((self.white, tables.zobrist_white), (self.black, tables.zobrist_black),
+                           (self.king, tables.zobrist_king)):
+            for index in iterate_bits(mask):
+                zobrist_hash ^= keys[index]
+        return zobrist_hash
+
+    @property
+    def board(self):
+        # the padded TileState array as used by TaflBoard. It is rebuilt lazily after the masks have changed. Like
+        # TaflBoard.do_action, a king on a corner replaces the corner state (the throne state is kept under a piece)
+        if self._board_cache is None:
+            tables = self.tables
+            width = tables.width
+            board = np.zeros(width * width, dtype=np.uint8)
+            for mask, tile_state in ((self.white, TileState.white), (self.black, TileState.black),
+                                     (self.king, TileState.king), (tables.throne, TileState.throne),
+                                     (tables.corners & ~self.king, TileState.corner),
+                                     (tables.border, TileState.border)):
+                bits = np.frombuffer(mask.to_bytes((width * width + 7) // 8, byteorder='little'), dtype=np.uint8)
+                board |= np.unpackbits(bits, bitorder='little')[:width * width] * np.uint8(tile_state)
+            self._board_cache = board.reshape((width, width))
+        return self._board_cache
+
+    def player_mask(self, player):
+        return self.black if player == Player.black else self.white | self.king
+
+    #  Checks whether "player" can do action "move".
+    #  move = ((fromX,fromY),(toX,toY))
+    def can_do_action(self, move, player):
+        (position_from, position_to) = move
+        return self.player_mask(player) & self.tables.bit(position_from) != 0 \
+            and move in self.get_valid_actions_for_piece(position_from)
+
+    # returns all valid actions for a player as a list of actions
+    def get_valid_actions(self, turn_player):
+        valid_actions = []
+        for index in iterate_bits(self.player_mask(turn_player)):
+            self._append_actions(index, valid_actions)
+        if len(valid_actions) == 0:
+            self.outcome = Outcome.white if turn_player == Player.black else Outcome.black
+            if self.print_to_console or self.print_game_over_reason:
+                print("It is " + str(turn_player) + "'s turn, but they can't make any moves. "
+                      + str(Player.white if turn_player == Player.black else Player.black) + " wins!")
+        return valid_actions
+
+    # returns all valid actions for a piece at a given position as a list of actions
+    def get_valid_actions_for_piece(self, position):
+        valid_actions = []
+        x, y = position
+        self._append_actions(int(x * self.tables.width + y), valid_actions)
+        return valid_actions
+
+    def _append_actions(self, index, valid_actions):
+        tables = self.tables
+        coordinates = tables.coordinates
+        position = coordinates[index]
+        piece = 1 << index
+        # the king standing on the throne moves like any other piece (same as in TaflBoard)
+        if piece & self.king and not piece & (tables.throne | tables.corners):
+            # the king is the only piece that may enter the corners and the throne
+            blockers = self.black | self.white | tables.border
+            targets = tables.all_tiles
+        else:
+            # all other pieces may pass the empty throne, but not stop on it
+            blockers = self.black | self.white | self.king | tables.corners | tables.border
+            targets = ~tables.throne
+        for direction, rays in enumerate(tables.rays):
+            ray = rays[index]
+            if direction % 2 == 0:
+                # decreasing indices: the nearest blocker is the highest set bit
+                nearest = 1 << ((ray & blockers).bit_length() - 1)
+                reachable = ray & ~((nearest << 1) - 1) & targets
+                valid_actions.extend((position, coordinates[other]) for other in iterate_bits_reversed(reachable))
+            else:
+                # increasing indices: the nearest blocker is the lowest set bit
+                blocked = ray & blockers
+                reachable = ray & ((blocked & -blocked) - 1) & targets
+                valid_actions.extend((position, coordinates[other]) for other in iterate_bits(reachable))
+
+    # returns whether a piece of "player" can move to "position" (see TaflBoard.can_reach)
+    def can_reach(self, player, position):
+        return len(self.moves_to(player, position)) > 0
+
+    # returns the moves of "player" that end on "position", ordered by the position of the moving piece.
+    # TaflBoard keeps a map for this, here the nearest blocker in each direction of the position is looked up instead
+    def moves_to(self, player, position):
+        tables = self.tables
+        x, y = position
+        index = int(x * tables.width + y)
+        target = 1 << index
+        occupied = self.black | self.white | self.king
+        if (occupied | tables.border) & target:
+            return []
+        own = self.player_mask(player)
+        blockers = occupied | tables.corners | tables.border
+        special = tables.throne | tables.corners
+        moves = []
+        for direction, rays in enumerate(tables.rays):
+            blocked = rays[index] & blockers
+            if direction % 2 == 0:
+                # decreasing indices: the nearest blocker is the highest set bit
+                nearest = 1 << (blocked.bit_length() - 1)
+            else:
+                nearest = blocked & -blocked
+            # only the king that doesn't stand on the throne may enter the corners and the throne
+            if own & nearest and (not target & special or self.king & nearest and not nearest & special):
+                moves.append((tables.coordinates[nearest.bit_length() - 1], (int(x), int(y))))
+        moves.sort()
+        return moves
+
+    # sets the tile at "position" to "tile_state" without any game logic (see TaflBoard.set_tile)
+    def set_tile(self, position, tile_state):
+        x, y = position
+        bit = self.tables.bit(position)
+        previous_pieces = (TileState.white if self.white & bit else 0) | (TileState.black if self.black & bit else 0) \
+            | (TileState.king if self.king & bit else 0)
+        self.zobrist_hash ^= ZOBRIST_TILE_KEYS[previous_pieces][x][y] ^ ZOBRIST_TILE_KEYS[tile_state & PIECES][x][y]
+        self.white = self.white | bit if tile_state & TileState.white else self.white & ~bit
+        self.black = self.black | bit if tile_state & TileState.black else self.black & ~bit
+        self.king = self.king | bit if tile_state & TileState.king else self.king & ~bit
+        self._board_cache = None
+
+    # the key under which the current piece placement is stored in board_states_dict
+    def state_key(self):
+        return self.zobrist_hash
+
+    # see TaflBoard.search_key()
+    def search_key(self, player):
+        return self.zobrist_hash ^ ZOBRIST_REPETITION_KEYS[self.board_states_dict.get(self.zobrist_hash, 0)] \
+            ^ (ZOBRIST_WHITE_TO_MOVE if player == Player.white else 0)
+
+    # executes "move" for the player "player" whose turn it is
+    # except when the game is already over. In this case it does nothing
+    def do_action(self, move, player):
+        # return immediately if game over
+        if self.outcome != Outcome.ongoing:
+            return
+
+        (from_x, from_y), (to_x, to_y) = move
+        if self.can_do_action(move, player):
+            if self.print_to_console:
+                print(str(player) + " moves a piece from " + str((from_x, from_y)) + " to " + str((to_x, to_y)))
+            tables = self.tables
+            index_from = int(from_x * tables.width + from_y)
+            index_to = int(to_x * tables.width + to_y)
+            bit_from = 1 << index_from
+            bit_to = 1 << index_to
+            move_mask = bit_from | bit_to
+            # if king is moving: update king position and check if he reached a corner
+            if self.king & bit_from:
+                self.king ^= move_mask
+                self.zobrist_hash ^= tables.zobrist_king[index_from] ^ tables.zobrist_king[index_to]
+                self.king_position = (to_x, to_y)
+                if tables.corners & bit_to:
+                    self.outcome = Outcome.white
+                    if self.print_to_console or self.print_game_over_reason:
+                        print("The king escapes to corner " + str((to_x, to_y)) + ". White wins!")
+            elif self.black & bit_from:
+                self.black ^= move_mask
+                self.zobrist_hash ^= tables.zobrist_black[index_from] ^ tables.zobrist_black[index_to]
+            else:
+                self.white ^= move_mask
+                self.zobrist_hash ^= tables.zobrist_white[index_from] ^ tables.zobrist_white[index_to]
+            self._board_cache = None
+            captured_pieces = self.capture((to_x, to_y), player)
+
+            # if pieces have been captured, we can reset the board states dict because from now on there are less
+            # pieces on the board than there ever were
+            if len(captured_pieces) > 0:
+                self.board_states_dict = {}
+
+            # update the board_states_dictionary so that we know whether the present board has occurred for the 3rd time
+            zobrist_hash = self.zobrist_hash
+            if zobrist_hash in self.board_states_dict:
+                self.board_states_dict[zobrist_hash] += 1
+                if self.board_states_dict[zobrist_hash] == 3:
+                    if player == Player.black:
+                        self.outcome = Outcome.black
+                        if self.print_to_console or self.print_game_over_reason:
+                            print("White forced the same board state for third time. Black wins!")
+                    else:
+                        self.outcome = Outcome.white
+                        if self.print_to_console or self.print_game_over_reason:
+                            print("Black forced the same board state for third time. White wins!")
+            else:
+                self.board_states_dict[zobrist_hash] = 1
+            return captured_pieces
+        else:
+            raise Exception(str(Player(player)) + " tried to make move " + str(move) + ", but that move is not possible. "
+                                                                               "Current board:\n" + self.__str__()
+                            + "\npossible actions: " + str(self.get_valid_actions(player)))
+
+    # see TaflBoard.push()
+    def push(self, move, player, undoable=True):
+        previous_states_dict = self.board_states_dict
+        frame = (self.black, self.white, self.king, self.zobrist_hash, self.king_position, self.white_pieces,
+                 self.black_pieces, self.outcome, previous_states_dict)
+        state_key = None
+        if move is None:
+            self.outcome = Outcome.black if player == Player.white else Outcome.white
+        elif self.outcome == Outcome.ongoing:
+            self.do_action(move, player)
+            if self.board_states_dict is previous_states_dict:
+                state_key = self.zobrist_hash
+        if undoable:
+            self.undo_stack.append(frame + (state_key,))
+
+    # takes back the last move made with push()
+    def pop(self):
+        self.black, self.white, self.king, self.zobrist_hash, self.king_position, self.white_pieces, \
+            self.black_pieces, self.outcome, states_dict, state_key = self.undo_stack.pop()
+        self._board_cache = None
+        if states_dict is not self.board_states_dict:
+            # the move captured pieces and started a new dict
+            self.board_states_dict = states_dict
+        elif state_key is not None:
+            if states_dict[state_key] == 1:
+                del states_dict[state_key]
+            else:
+                states_dict[state_key] -= 1
+
+    # captures all enemy pieces around the position "position_to" that the player "player" has just moved a piece to
+    def capture(self, position_to, turn_player):
+        tables = self.tables
+        x, y = position_to
+        index = int(x * tables.width + y)
+        captured_pieces = []
+
+        own = self.player_mask(turn_player)
+        # the empty throne is hostile to any piece
+        hostile = own | tables.corners | (0 if self.king & tables.throne else tables.throne)
+
+        # bottom, top, right, left (same order as TaflBoard)
+        for step in (tables.width, -tables.width, 1, -1):
+            neighbour = 1 << (index + step)
+            if turn_player == Player.black:
+                if self.white & neighbour and hostile & (1 << (index + 2 * step)):
+                    self.white ^= neighbour
+                    self.zobrist_hash ^= tables.zobrist_white[index + step]
+                    captured_pieces.append(tables.coordinates[index + step])
+            elif self.black & neighbour and hostile & (1 << (index + 2 * step)):
+                self.black ^= neighbour
+                self.zobrist_hash ^= tables.zobrist_black[index + step]
+                captured_pieces.append(tables.coordinates[index + step])
+        if captured_pieces:
+            self._board_cache = None
+            if self.print_to_console:
+                for position in captured_pieces:
+                    print(str(turn_player) + " captures piece at " + str(position))
+
+        # check capture king
+        # check if this piece has moved next to the king at all (otherwise it would be impossible for the king to move
+        # between two black pieces, as is done in the examples)
+        if self.king and any(self.king & (1 << (index + step)) and (own | tables.throne) & (1 << (index + 2 * step))
+                             for step in (tables.width, -tables.width, 1, -1)):
+            king_index = self.king.bit_length() - 1
+            bottom, top = 1 << (king_index + tables.width), 1 << (king_index - tables.width)
+            right, left = 1 << (king_index + 1), 1 << (king_index - 1)
+            surrounding = bottom | top | right | left
+            # check: (king is on or next to throne and surrounded on all for sides)
+            # or (between to black pieces in vertical direction)
+            # or (between to black pieces in horizontal direction)
+            if (self.king | surrounding) & tables.throne:
+                king_capture = surrounding & ~(self.black | tables.throne) == 0
+            else:
+                king_capture = self.black & (bottom | top) == bottom | top or self.black & (right | left) == right | left
+            if king_capture:
+                self.outcome = Outcome.black
+                captured_pieces.append(self.king_position)
+                if self.print_to_console or self.print_game_over_reason:
+                    print("Black wins by capturing the king at " + str(self.king_position) + "!")
+
+        if turn_player == Player.white:
+            self.black_pieces -= len(captured_pieces)
+        else:
+            self.white_pieces -= len(captured_pieces)
+
+        return captured_pieces
+
+    def __str__(self):
+        return np.array_str(self.board) + str(self.board_states_dict[self.state_key()])
+
+    # see TaflBoard.bytes()
+    def bytes(self):
+        return self.board[1:self.size + 1, 1: self.size + 1].tobytes() \
+               + self.board_states_dict[self.state_key()].to_bytes(1, byteorder='big')
@@ -1,3 +1,5 @@
+import random
+
 import numpy as np
 from enum import IntEnum
 
@@ -24,6 +26,32 @@ class Outcome(IntEnum):
     draw = 2
 
 
+# Zobrist hashing: every (piece, tile) combination gets a random 64-bit key and the hash of a position is the xor of
+# the keys of all pieces on the board. A move only changes a few tiles, so the hash can be updated incrementally.
+# ZOBRIST_TILE_KEYS[tile_state & (white | black | king)][x][y] covers the padded tiles of boards up to 11x11
+_zobrist_random = random.Random(0x7af1)
+_ZOBRIST_PADDED_SIZE = 13
+_zobrist_piece_keys = {tile_state: [[_zobrist_random.getrandbits(64) for _ in range(_ZOBRIST_PADDED_SIZE)]
+                                    for _ in range(_ZOBRIST_PADDED_SIZE)]
+                       for tile_state in (TileState.white, TileState.black, TileState.king)}
+ZOBRIST_TILE_KEYS = [[[0] * _ZOBRIST_PADDED_SIZE for _ in range(_ZOBRIST_PADDED_SIZE)] for _ in range(8)]
+for _pieces in range(8):
+    for _x in range(_ZOBRIST_PADDED_SIZE):
+        for _y in range(_ZOBRIST_PADDED_SIZE):
+            for _tile_state, _keys in _zobrist_piece_keys.items():
+                if _pieces & _tile_state:
+                    ZOBRIST_TILE_KEYS[_pieces][_x][_y] ^= _keys[_x][_y]
+# mixed into the search keys (see TaflBoard.search_key): how often the position occurred and whether white is to move
+ZOBRIST_REPETITION_KEYS = [_zobrist_random.getrandbits(64) for _ in range(4)]
+ZOBRIST_WHITE_TO_MOVE = _zobrist_random.getrandbits(64)
+
+PIECES = TileState.white | TileState.black | TileState.king
+
+# the directions in the order in which the moves of a piece are generated: up, down, left, right.
+# The opposite of direction d is d ^ 1
+DIRECTIONS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+
+
 class TaflBoard:
 
     def __init__(self, size):
@@ -33,8 +61,11 @@ class TaflBoard:
 
         self.king_position = ((self.size + 1)/2, (self.size + 1)/2)
 
-        # holds all board states and the frequency how often they occurred
-        self.board_states_dict = {self.board.tobytes(): 1}
+        # Zobrist hash of the piece placement, updated with every move
+        self.zobrist_hash = 0
+
+        # holds the Zobrist hashes of all board states and the frequency how often they occurred
+        self.board_states_dict = {self.zobrist_hash: 1}
 
         # the outcome of the current match
         self.outcome = Outcome.ongoing
@@ -51,6 +82,17 @@ class TaflBoard:
 
         self.print_game_over_reason = False
 
+        # one entry per push() so that pop() can take the move back
+        self.undo_stack = []
+
+        # line-of-sight maps, kept up to date with every tile that changes (see change_tiles):
+        #   lines[player][position]: the moves of the piece at position, one list per direction
+        #   reach[player][x][y]: the number of pieces of player that can move to (x, y)
+        self.lines = {Player.white: {}, Player.black: {}}
+        self.reach = {Player.white: [], Player.black: []}
+        # the pieces whose lines the current push() changed together with their previous lines, see pop()
+        self.lines_journal = None
+
         self.reset_board()
 
     def reset_board(self):
@@ -125,8 +167,18 @@ class TaflBoard:
         self.board[self.size, self.size] = TileState.corner
         self.board[self.size, 1] = TileState.corner
 
-        self.board_states_dict = {self.board.tobytes(): 1}
+        self.zobrist_hash = self.compute_zobrist_hash()
+        self.board_states_dict = {self.zobrist_hash: 1}
         self.outcome = Outcome.ongoing
+        self.undo_stack = []
+        self.build_lines()
+
+    # computes the Zobrist hash of the board from scratch. Moves update self.zobrist_hash incrementally instead
+    def compute_zobrist_hash(self):
+        zobrist_hash = 0
+        for (x, y), tile_state in np.ndenumerate(self.board & PIECES):
+            zobrist_hash ^= ZOBRIST_TILE_KEYS[tile_state][x][y]
+        return zobrist_hash
 
     #  Checks whether "player" can do action "move".
     #  move = ((fromX,fromY),(toX,toY))
@@ -138,10 +190,11 @@ class TaflBoard:
     # returns all valid actions for a player as a list of actions
     def get_valid_actions(self, turn_player):
         valid_actions = []
-        player_tilestate = TileState.black if turn_player == Player.black else TileState.white | TileState.king
-        for position, tilestate in np.ndenumerate(self.board):
-            if tilestate & player_tilestate != 0:
-                valid_actions.extend(self.get_valid_actions_for_piece(position))
+        pieces = self.lines[turn_player]
+        # sorted, so that the actions come in the same order as when the board is walked row by row
+        for position in sorted(pieces):
+            for moves in pieces[position]:
+                valid_actions.extend(moves)
         if len(valid_actions) == 0:
             self.outcome = Outcome.white if turn_player == Player.black else Outcome.black
             if self.print_to_console or self.print_game_over_reason:
@@ -152,41 +205,144 @@ class TaflBoard:
     # returns all valid actions for a piece at a given position as a list of actions
     def get_valid_actions_for_piece(self, position):
         x, y = position
-        is_king = self.board[x, y] == TileState.king
-        valid_actions = []
-        # first direction
-        for x_other in reversed(range(1, x)):
-            if self.board[x_other, y] == TileState.empty or \
-                    (is_king and self.board[x_other, y] & (TileState.corner | TileState.throne) != 0):
-                valid_actions.append(((x, y), (x_other, y)))
-            else:
-                if self.board[x_other, y] != TileState.throne:
-                    break
-        # second direction
-        for x_other in range(x + 1, self.size + 1):
-            if self.board[x_other, y] == TileState.empty or \
-                    (is_king and self.board[x_other, y] & (TileState.corner | TileState.throne) != 0):
-                valid_actions.append(((x, y), (x_other, y)))
-            else:
-                if self.board[x_other, y] != TileState.throne:
-                    break
-        # third direction
-        for y_other in reversed(range(1, y)):
-            if self.board[x, y_other] == TileState.empty or \
-                    (is_king and self.board[x, y_other] & (TileState.corner | TileState.throne) != 0):
-                valid_actions.append(((x, y), (x, y_other)))
-            else:
-                if self.board[x, y_other] != TileState.throne:
-                    break
-        # forth direction
-        for y_other in range(y + 1, self.size + 1):
-            if self.board[x, y_other] == TileState.empty or \
-                    (is_king and self.board[x, y_other] & (TileState.corner | TileState.throne) != 0):
-                valid_actions.append(((x, y), (x, y_other)))
-            else:
-                if self.board[x, y_other] != TileState.throne:
-                    break
-        return valid_actions
+        position = (int(x), int(y))
+        for pieces in self.lines.values():
+            if position in pieces:
+                up, down, left, right = pieces[position]
+                return up + down + left + right
+        return []
+
+    # returns whether a piece of "player" can move to "position"
+    def can_reach(self, player, position):
+        x, y = position
+        return self.reach[player][x][y] > 0
+
+    # returns the moves of "player" that end on "position", ordered by the position of the moving piece
+    def moves_to(self, player, position):
+        x, y = position
+        if self.reach[player][x][y] == 0:
+            return []
+        position = (int(x), int(y))
+        pieces = self.lines[player]
+        moves = []
+        for piece, direction in self.pieces_in_sight(position):
+            if piece in pieces and (piece, position) in pieces[piece][direction]:
+                moves.append((piece, position))
+        moves.sort()
+        return moves
+
+    # returns the moves of the piece at "position" in one direction
+    def line_moves(self, position, direction):
+        board = self.board
+        x, y = position
+        dx, dy = DIRECTIONS[direction]
+        # the king standing on the throne moves like any other piece
+        is_king = board.item(x, y) == TileState.king
+        moves = []
+        x_other = x + dx
+        y_other = y + dy
+        while True:
+            tile_state = board.item(x_other, y_other)
+            if tile_state == TileState.empty or \
+                    (is_king and tile_state & (TileState.corner | TileState.throne) != 0):
+                moves.append((position, (x_other, y_other)))
+            elif tile_state != TileState.throne:
+                break
+            x_other += dx
+            y_other += dy
+        return moves
+
+    # returns (piece position, direction) of the nearest piece in each direction of "position" together with the
+    # direction in which its moves run towards "position". Only the empty tiles and the empty throne are looked past
+    def pieces_in_sight(self, position):
+        board = self.board
+        x, y = position
+        pieces = []
+        for direction, (dx, dy) in enumerate(DIRECTIONS):
+            x_other = x + dx
+            y_other = y + dy
+            tile_state = board.item(x_other, y_other)
+            while tile_state == TileState.empty or tile_state == TileState.throne:
+                x_other += dx
+                y_other += dy
+                tile_state = board.item(x_other, y_other)
+            if tile_state & PIECES != 0:
+                pieces.append(((x_other, y_other), direction ^ 1))
+        return pieces
+
+    # the player owning the piece on a tile or None
+    @staticmethod
+    def tile_player(tile_state):
+        if tile_state & TileState.black != 0:
+            return Player.black
+        if tile_state & (TileState.white | TileState.king) != 0:
+            return Player.white
+        return None
+
+    # computes the line-of-sight maps from scratch. Moves update them incrementally instead
+    def build_lines(self):
+        self.lines = {Player.white: {}, Player.black: {}}
+        self.reach = {player: [[0] * (self.size + 2) for _ in range(self.size + 2)] for player in Player}
+        for (x, y), tile_state in np.ndenumerate(self.board):
+            player = self.tile_player(tile_state)
+            if player is not None:
+                self.replace_lines(player, (x, y), [self.line_moves((x, y), direction) for direction in range(4)])
+
+    # sets the lines of the piece of "player" at "position" (None removes the piece) and updates the reach map.
+    # Returns the previous lines
+    def replace_lines(self, player, position, lines):
+        pieces = self.lines[player]
+        reach = self.reach[player]
+        previous_lines = pieces.pop(position, None)
+        if previous_lines is not None:
+            for moves in previous_lines:
+                for _, (x, y) in moves:
+                    reach[x][y] -= 1
+        if lines is not None:
+            for moves in lines:
+                for _, (x, y) in moves:
+                    reach[x][y] += 1
+            pieces[position] = lines
+        return previous_lines
+
+    # sets the tiles of all (position, tile_state) in "changes" and updates the line-of-sight maps. Only the lines of
+    # the changed tiles and the lines of the pieces that look at one of them have to be computed again
+    def change_tiles(self, changes):
+        board = self.board
+        changed = [(int(x), int(y)) for (x, y), _ in changes]
+        # the lines that ran through or ended at a changed tile
+        affected = {}
+        for position in changed:
+            for piece, direction in self.pieces_in_sight(position):
+                affected.setdefault(piece, set()).add(direction)
+        for position, tile_state in zip(changed, (tile_state for _, tile_state in changes)):
+            board[position] = tile_state
+        # the lines that run through or end at a changed tile now
+        for position in changed:
+            for piece, direction in self.pieces_in_sight(position):
+                affected.setdefault(piece, set()).add(direction)
+
+        journal = self.lines_journal
+        for position in changed:
+            affected.pop(position, None)
+            for player, pieces in self.lines.items():
+                if position in pieces:
+                    previous_lines = self.replace_lines(player, position, None)
+                    if journal is not None:
+                        journal.append((player, position, previous_lines))
+            player = self.tile_player(board.item(*position))
+            if player is not None:
+                self.replace_lines(player, position, [self.line_moves(position, direction) for direction in range(4)])
+                if journal is not None:
+                    journal.append((player, position, None))
+        for position, directions in affected.items():
+            player = self.tile_player(board.item(*position))
+            lines = list(self.lines[player][position])
+            for direction in directions:
+                lines[direction] = self.line_moves(position, direction)
+            previous_lines = self.replace_lines(player, position, lines)
+            if journal is not None:
+                journal.append((player, position, previous_lines))
 
     # executes "move" for the player "player" whose turn it is
     # except when the game is already over. In this case it does nothing
@@ -207,13 +363,15 @@ class TaflBoard:
                     if self.print_to_console or self.print_game_over_reason:
                         print("The king escapes to corner " + str((to_x, to_y)) + ". White wins!")
             # update the board itself and capture pieces if applicable
+            piece = self.board[from_x, from_y] & PIECES
+            self.zobrist_hash ^= ZOBRIST_TILE_KEYS[piece][from_x][from_y] ^ ZOBRIST_TILE_KEYS[piece][to_x][to_y]
 
             # keep throne tile state if it is there and move the piece from the other tile here
-            self.board[to_x, to_y] = (self.board[to_x, to_y] & TileState.throne) |\
-                                     (self.board[from_x, from_y] & (TileState.white | TileState.black | TileState.king))
-            # clear the old tile from pieces
-            self.board[from_x, from_y] = self.board[from_x, from_y] & \
-                                         ~(TileState.white | TileState.black | TileState.king)  # remove piece from tile
+            # and clear the old tile from pieces
+            self.change_tiles([((to_x, to_y), (self.board[to_x, to_y] & TileState.throne) |
+                                (self.board[from_x, from_y] & (TileState.white | TileState.black | TileState.king))),
+                               ((from_x, from_y), self.board[from_x, from_y] &
+                                ~(TileState.white | TileState.black | TileState.king))])  # remove piece from tile
             captured_pieces = self.capture((to_x, to_y), player)
 
             # if pieces have been captured, we can reset the board states dict because from now on there are less
@@ -222,10 +380,10 @@ class TaflBoard:
                 self.board_states_dict = {}
 
             # update the board_states_dictionary so that we know whether the present board has occurred for the 3rd time
-            board_bytes = self.board.tobytes()
-            if board_bytes in self.board_states_dict:
-                self.board_states_dict[board_bytes] += 1
-                if self.board_states_dict[board_bytes] == 3:
+            zobrist_hash = self.zobrist_hash
+            if zobrist_hash in self.board_states_dict:
+                self.board_states_dict[zobrist_hash] += 1
+                if self.board_states_dict[zobrist_hash] == 3:
                     if player == Player.black:
                         self.outcome = Outcome.black
                         if self.print_to_console or self.print_game_over_reason:
@@ -235,13 +393,48 @@ class TaflBoard:
                         if self.print_to_console or self.print_game_over_reason:
                             print("Black forced the same board state for third time. White wins!")
             else:
-                self.board_states_dict[board_bytes] = 1
+                self.board_states_dict[zobrist_hash] = 1
             return captured_pieces
         else:
             raise Exception(str(Player(player)) + " tried to make move " + str(move) + ", but that move is not possible. "
                                                                                "Current board:\n" + self.__str__()
                             + "\npossible actions: " + str(self.get_valid_actions(player)))
 
+    # like do_action, but remembers everything that is needed to take the move back with pop(). This is used to walk
+    # the search tree in place instead of copying the board. move=None means that "player" can't move and loses.
+    # undoable=False makes a move of the real game, which is never taken back and keeps no undo history
+    def push(self, move, player, undoable=True):
+        previous_states_dict = self.board_states_dict
+        if undoable:
+            frame = (self.board.copy(), self.zobrist_hash, self.king_position, self.white_pieces, self.black_pieces,
+                     self.outcome, previous_states_dict)
+            self.lines_journal = []
+        state_key = None
+        if move is None:
+            self.outcome = Outcome.black if player == Player.white else Outcome.white
+        elif self.outcome == Outcome.ongoing:
+            self.do_action(move, player)
+            if self.board_states_dict is previous_states_dict:
+                state_key = self.zobrist_hash
+        if undoable:
+            self.undo_stack.append(frame + (state_key, self.lines_journal))
+            self.lines_journal = None
+
+    # takes back the last move made with push()
+    def pop(self):
+        self.board, self.zobrist_hash, self.king_position, self.white_pieces, self.black_pieces, self.outcome, \
+            states_dict, state_key, lines_journal = self.undo_stack.pop()
+        for player, position, lines in reversed(lines_journal):
+            self.replace_lines(player, position, lines)
+        if states_dict is not self.board_states_dict:
+            # the move captured pieces and started a new dict
+            self.board_states_dict = states_dict
+        elif state_key is not None:
+            if states_dict[state_key] == 1:
+                del states_dict[state_key]
+            else:
+                states_dict[state_key] -= 1
+
     # captures all enemy pieces around the position "position_to" that the player "player" has just moved a piece to
     def capture(self, position_to, turn_player):
         x, y = position_to
@@ -256,7 +449,8 @@ class TaflBoard:
         # check capture bottom
         if self.board[x + 1, y] & opponent_pawn_tile_state != 0 \
                 and self.board[x + 2, y] & (own_tile_state | TileState.corner | throne_check) != 0:
-            self.board[x + 1, y] = TileState.empty
+            self.change_tiles([((x + 1, y), TileState.empty)])
+            self.zobrist_hash ^= ZOBRIST_TILE_KEYS[opponent_pawn_tile_state][x + 1][y]
             captured_pieces.append((x + 1, y))
             if self.print_to_console:
                 print(str(turn_player) + " captures piece at " + str((x + 1, y)))
@@ -264,7 +458,8 @@ class TaflBoard:
         # check capture top
         if self.board[x - 1, y] & opponent_pawn_tile_state != 0 \
                 and self.board[x - 2, y] & (own_tile_state | TileState.corner | throne_check) != 0:
-            self.board[x - 1, y] = TileState.empty
+            self.change_tiles([((x - 1, y), TileState.empty)])
+            self.zobrist_hash ^= ZOBRIST_TILE_KEYS[opponent_pawn_tile_state][x - 1][y]
             captured_pieces.append((x - 1, y))
             if self.print_to_console:
                 print(str(turn_player) + " captures piece at " + str((x - 1, y)))
@@ -272,7 +467,8 @@ class TaflBoard:
         # check capture right
         if self.board[x, y + 1] & opponent_pawn_tile_state != 0 \
                 and self.board[x, y + 2] & (own_tile_state | TileState.corner | throne_check) != 0:
-            self.board[x, y + 1] = TileState.empty
+            self.change_tiles([((x, y + 1), TileState.empty)])
+            self.zobrist_hash ^= ZOBRIST_TILE_KEYS[opponent_pawn_tile_state][x][y + 1]
             captured_pieces.append((x, y + 1))
             if self.print_to_console:
                 print(str(turn_player) + " captures piece at " + str((x, y + 1)))
@@ -280,7 +476,8 @@ class TaflBoard:
         # check capture left
         if self.board[x, y - 1] & opponent_pawn_tile_state != 0 \
                 and self.board[x, y - 2] & (own_tile_state | TileState.corner | throne_check) != 0:
-            self.board[x, y - 1] = TileState.empty
+            self.change_tiles([((x, y - 1), TileState.empty)])
+            self.zobrist_hash ^= ZOBRIST_TILE_KEYS[opponent_pawn_tile_state][x][y - 1]
             captured_pieces.append((x, y - 1))
             if self.print_to_console:
                 print(str(turn_player) + " captures piece at " + str((x, y - 1)))
@@ -330,10 +527,29 @@ class TaflBoard:
 
         return captured_pieces
 
+    # sets the tile at "position" to "tile_state" without any game logic. Used by the move heuristics to temporarily
+    # try out moves, callers are responsible for restoring the previous tile state
+    def set_tile(self, position, tile_state):
+        x, y = position
+        self.zobrist_hash ^= ZOBRIST_TILE_KEYS[self.board[position] & PIECES][x][y] \
+            ^ ZOBRIST_TILE_KEYS[tile_state & PIECES][x][y]
+        self.change_tiles([(position, tile_state)])
+
+    # the key under which the current piece placement is stored in board_states_dict
+    def state_key(self):
+        return self.zobrist_hash
+
+    # 64-bit key of the current board state for the search tree. Unlike state_key() it also distinguishes how often
+    # the piece placement has occurred and which player is to move
+    def search_key(self, player):
+        return self.zobrist_hash ^ ZOBRIST_REPETITION_KEYS[self.board_states_dict.get(self.zobrist_hash, 0)] \
+            ^ (ZOBRIST_WHITE_TO_MOVE if player == Player.white else 0)
+
     def __str__(self):
-        return np.array_str(self.board) + str(self.board_states_dict[self.board.tobytes()])
+        return np.array_str(self.board) + str(self.board_states_dict[self.state_key()])
 
-    # bytes are much faster than strings, so use this method if you can
+    # serializes the full board (plus the repetition count). Only needed when the board itself has to be stored,
+    # use state_key() or search_key() to identify positions
     def bytes(self):
-        return self.board[1:self.size + 1, 1: self.size + 1].tostring() \
-               + self.board_states_dict[self.board.tobytes()].to_bytes(1, byteorder='big')
+        return self.board[1:self.size + 1, 1: self.size + 1].tobytes() \
+               + self.board_states_dict[self.state_key()].to_bytes(1, byteorder='big')
@@ -5,7 +5,11 @@ from enum import IntEnum
 import numpy as np
 
 from Game import Game
-from tafl.TaflBoard import Outcome, Player, TaflBoard, TileState
+from tafl.ActionCodec import get_action_codec
+from tafl.TaflBitBoard import TaflBitBoard
+from tafl.SymmetryTables import NUMBER_OF_SYMMETRIES, get_symmetry_tables
+from tafl.TacticalOracle import TacticalOracle
+from tafl.TaflBoard import Outcome, PIECES, Player, TaflBoard, TileState, ZOBRIST_TILE_KEYS
 
 
 class MovementType(IntEnum):
@@ -23,12 +27,16 @@ class TaflGame(Game):
     See othello/OthelloGame.py for an example implementation.
     """
 
-    def __init__(self, size, prune):
+    def __init__(self, size, prune, bitboard=False, debug_actions=False):
         if size != 11 and size != 9 and size != 7:
             raise ValueError
         self.size = size
         self.prune = prune
         self.prune_prob = 0.1
+        # use the bitmask board backend instead of the numpy one
+        self.bitboard = bitboard
+        # conversion between action indices and moves, debug_actions checks every conversion
+        self.codec = get_action_codec(size, debug_actions)
 
     def getInitBoard(self):
         """
@@ -36,7 +44,7 @@ class TaflGame(Game):
             startBoard: a representation of the board (ideally this is the form
                         that will be the input to your neural network)
         """
-        return TaflBoard(self.size)
+        return TaflBitBoard(self.size) if self.bitboard else TaflBoard(self.size)
 
     def getBoardSize(self):
         """
@@ -54,28 +62,32 @@ class TaflGame(Game):
         # size for horizontal movement, size for vertical movement, so size*2 to select the action to take
         return self.size*self.size*self.size*2+1
 
-    def getNextState(self, board, player, action, copy_board=False):
+    def getNextState(self, board, player, action, copy_board=False, undoable=False):
         """
         Input:
             board: current board
             player: current player (1 or -1)
             action: action taken by current player
 
+        The action is applied to board itself (unless copy_board is set). With
+        undoable set it can be taken back with board.pop() (as the search
+        does), moves of the real game keep no undo history.
+
         Returns:
             nextBoard: board after applying action
             nextPlayer: player who plays in the next turn (should be -player)
         """
 
+        if copy_board:
+            board = copy.deepcopy(board)
         if action == self.getActionSize() - 1:
-            board.outcome = Outcome.black if player == Player.white else Player.black
+            # the player has no moves left and loses
+            board.push(None, player, undoable)
             # assert board.outcome != Outcome.ongoing, str(player) + " selected 'no action', but had still moves left\n" \
             #                                          + str(board) + "\n" + str(list(board.get_valid_actions(player)))
         else:
-            explicit = action_conversion__index_to_explicit(action, self.size)
-            assert action_conversion__explicit_to_index(explicit, self.size) == action
-            if copy_board:
-                board = copy.deepcopy(board)
-            board.do_action(explicit, player)
+            explicit = self.codec.decode(action)
+            board.push(explicit, player, undoable)
         next_player = -1 if player == 1 else 1
         return board, next_player
 
@@ -115,8 +127,9 @@ class TaflGame(Game):
                             break
                     # 5.
                     if winning_move is None:
+                        oracle = TacticalOracle(board, Player.white)
                         for action in move_set:
-                            if not would_next_board_lead_to_opponent_winning(board, action, Player.white):
+                            if not oracle.is_losing_move(action):
                                 non_losing_moves.append(action)
             # black:
             # preferences:
@@ -129,7 +142,7 @@ class TaflGame(Game):
             else:
                 move_set = board.get_valid_actions(player)
                 # 1.
-                winning_move = get_king_capture_move(board, move_set)
+                winning_move = get_king_capture_move(board)
                 if winning_move is None:
                     # 2.
                     for action in move_set:
@@ -138,25 +151,24 @@ class TaflGame(Game):
                             break
                     # 3., 4. and 5.
                     if winning_move is None:
+                        oracle = TacticalOracle(board, Player.black)
                         for action in move_set:
-                            if not would_next_board_lead_to_opponent_winning(board, action, Player.black):
+                            if not oracle.is_losing_move(action):
                                 non_losing_moves.append(action)
 
             # set winning move if it exists
             if winning_move is not None:
-                index = action_conversion__explicit_to_index(winning_move, self.size)
+                index = self.codec.encode(winning_move)
                 array[index] = 1
             else:
                 # set non losing moves if they exist, but not a winning move
-                for explicit in non_losing_moves:
-                    index = action_conversion__explicit_to_index(explicit, self.size)
-                    array[index] = 1
+                array[self.codec.encode_moves(non_losing_moves)] = 1
             # set any move if both don't exist
             if winning_move is None and non_losing_moves == []:
                 if len(move_set) == 0:
                     index = self.getActionSize()-1
                 else:
-                    index = action_conversion__explicit_to_index(random.choice(move_set), self.size)
+                    index = self.codec.encode(random.choice(move_set))
                 array[index] = 1
 
         else:
@@ -165,13 +177,11 @@ class TaflGame(Game):
             for action in move_set:
                 if board.would_next_board_be_third(action):
                     array = np.zeros(self.getActionSize())
-                    index = action_conversion__explicit_to_index(action, self.size)
-                    assert action_conversion__index_to_explicit(index, self.size) == action
+                    index = self.codec.encode(action)
                     array[index] = 1
                     return array
                 elif not board.would_next_board_lead_to_third(action, player):
-                    index = action_conversion__explicit_to_index(action, self.size)
-                    assert action_conversion__index_to_explicit(index, self.size) == action
+                    index = self.codec.encode(action)
                     array[index] = 1
                     no_immediate_loss_possible = True
             # if all possible moves lead to a loss...
@@ -184,7 +194,7 @@ class TaflGame(Game):
                 if len(move_set) == 0:
                     index = self.getActionSize()-1
                 else:
-                    index = action_conversion__explicit_to_index(random.choice(move_set), self.size)
+                    index = self.codec.encode(random.choice(move_set))
                 array[index] = 1
         return array
 
@@ -238,136 +248,63 @@ class TaflGame(Game):
                        form of the board and the corresponding pi vector. This
                        is used when training the neural network from examples.
         """
-        actions_and_probs = [(index, prob)for index, prob in enumerate(pi) if prob != 0]
-        king_x, king_y = king_position
-
-        symmetries = []
-        # occurrences = np.zeros(self.size*self.size*self.size*2)
-        # for index, prob in actions_and_probs:
-        #    ((x_from, y_from), (x_to, y_to)) = action_conversion__index_to_explicit(index, self.size)
-        #     explicit = (self.size + 1 - x_from, y_from), (self.size + 1 - x_to, y_to)
-        #     occurrences[index] = 1 if board.would_next_board_be_second_third(2, explicit) else 0
-
-        #original
-        temp_board = np.copy(board.board[1:self.size + 1, 1:self.size + 1])
-        symmetries.append((temp_board, pi, (king_x, king_y)))
-
-        # horizontal flip
-        temp_board = np.flip(temp_board, 0)
-        temp_pi = np.zeros(self.size * self.size * self.size * 2 + 1)
-        for index, prob in actions_and_probs:
-            if index == self.size * self.size * self.size * 2:
-                temp_pi[index] = prob
-            else:
-                ((x_from, y_from), (x_to, y_to)) = action_conversion__index_to_explicit(index, self.size)
-                explicit = (self.size + 1 - x_from, y_from), (self.size + 1 - x_to, y_to)
-                temp_pi[action_conversion__explicit_to_index(explicit, self.size)] = prob
-        symmetries.append((temp_board, temp_pi, (self.size + 1 - king_x, king_y)))
-
-        # horizontal and vertical flip
-        temp_board = np.flip(temp_board, 1)
-        temp_pi = np.zeros(self.size * self.size * self.size * 2 + 1)
-        for index, prob in actions_and_probs:
-            if index == self.size * self.size * self.size * 2:
-                temp_pi[index] = prob
-            else:
-                ((x_from, y_from), (x_to, y_to)) = action_conversion__index_to_explicit(index, self.size)
-                explicit = (self.size + 1 - x_from, self.size + 1 - y_from), (self.size + 1 - x_to, self.size + 1 - y_to)
-                temp_pi[action_conversion__explicit_to_index(explicit, self.size)] = prob
-        symmetries.append((temp_board, temp_pi, (self.size + 1 - king_x, self.size + 1 - king_y)))
-
-        # vertical flip
-        temp_board = np.flip(temp_board, 0)
-        temp_pi = np.zeros(self.size * self.size * self.size * 2 + 1)
-        for index, prob in actions_and_probs:
-            if index == self.size * self.size * self.size * 2:
-                temp_pi[index] = prob
-            else:
-                ((x_from, y_from), (x_to, y_to)) = action_conversion__index_to_explicit(index, self.size)
-                explicit = (x_from, self.size + 1 - y_from), (x_to, self.size + 1 - y_to)
-                temp_pi[action_conversion__explicit_to_index(explicit, self.size)] = prob
-        symmetries.append((temp_board, temp_pi, (king_x, self.size + 1 - king_y)))
-
-        # rotation
-        temp_board = np.flip(temp_board, 1)
-        temp_board = np.rot90(temp_board)
-        temp_pi = np.zeros(self.size * self.size * self.size * 2 + 1)
-        for index, prob in actions_and_probs:
-            if index == self.size * self.size * self.size * 2:
-                temp_pi[index] = prob
-            else:
-                ((x_from, y_from), (x_to, y_to)) = action_conversion__index_to_explicit(index, self.size)
-                explicit = (self.size + 1 - y_from, x_from), (self.size + 1 - y_to, x_to)
-                temp_pi[action_conversion__explicit_to_index(explicit, self.size)] = prob
-        symmetries.append((temp_board, temp_pi, (self.size + 1 - king_y, king_x)))
-
-        # rotation and horizontal flip
-        temp_board = np.flip(temp_board, 0)
-        temp_pi = np.zeros(self.size * self.size * self.size * 2 + 1)
-        for index, prob in actions_and_probs:
-            if index == self.size * self.size * self.size * 2:
-                temp_pi[index] = prob
-            else:
-                ((x_from, y_from), (x_to, y_to)) = action_conversion__index_to_explicit(index, self.size)
-                explicit = (y_from, x_from), (y_to, x_to)
-                temp_pi[action_conversion__explicit_to_index(explicit, self.size)] = prob
-        symmetries.append((temp_board, temp_pi, (king_y, king_x)))
-
-        # rotation and horizontal and vertical flip
-        temp_board = np.flip(temp_board, 1)
-        temp_pi = np.zeros(self.size * self.size * self.size * 2 + 1)
-        for index, prob in actions_and_probs:
-            if index == self.size * self.size * self.size * 2:
-                temp_pi[index] = prob
-            else:
-                ((x_from, y_from), (x_to, y_to)) = action_conversion__index_to_explicit(index, self.size)
-                explicit = (y_from, self.size + 1 - x_from), (y_to, self.size + 1 - x_to)
-                temp_pi[action_conversion__explicit_to_index(explicit, self.size)] = prob
-        symmetries.append((temp_board, temp_pi, (king_y, self.size + 1 - king_x)))
-
-        # rotation and vertical flip
-        temp_board = np.flip(temp_board, 0)
-        temp_pi = np.zeros(self.size * self.size * self.size * 2 + 1)
-        for index, prob in actions_and_probs:
-            if index == self.size * self.size * self.size * 2:
-                temp_pi[index] = prob
-            else:
-                ((x_from, y_from), (x_to, y_to)) = action_conversion__index_to_explicit(index, self.size)
-                explicit = (self.size + 1 - y_from, self.size + 1 - x_from), (self.size + 1 - y_to, self.size + 1 - x_to)
-                temp_pi[action_conversion__explicit_to_index(explicit, self.size)] = prob
-        symmetries.append((temp_board, temp_pi, (self.size + 1 - king_y, king_x)))
+        # the permutations of all 8 symmetries are precomputed, see tafl/SymmetryTables.py
+        boards, pis, king_positions = get_symmetry_tables(self.size).transform(
+            board.board[1:self.size + 1, 1:self.size + 1], pi, king_position)
+        return [(boards[k], pis[k], (int(king_positions[k, 0]), int(king_positions[k, 1])))
+                for k in range(NUMBER_OF_SYMMETRIES)]
 
-        return symmetries
+    def getSymmetriesBatch(self, boards, pis, king_positions):
+        """
+        Input:
+            boards: array of shape (n, size, size), the boards without the border
+            pis: array of shape (n, self.getActionSize())
+            king_positions: array of shape (n, 2)
+
+        Returns:
+            (boards, pis, king_positions): the symmetrical forms of all n
+                                           examples as arrays of length 8 * n,
+                                           in the order of getSymmetries for
+                                           every example
+        """
+        return get_symmetry_tables(self.size).transform_batch(boards, pis, king_positions)
+
+    def getSparseSymmetriesBatch(self, boards, pis, king_positions):
+        """
+        Input:
+            boards: array of shape (n, size, size), the boards without the border
+            pis: list of n sparse policies (indices, probs), see
+                 MCTS.getActionProb
+            king_positions: array of shape (n, 2)
+
+        Returns:
+            (boards, pis, king_positions): like getSymmetriesBatch, but pis is
+                                           a list of 8 * n sparse policies
+        """
+        return get_symmetry_tables(self.size).transform_sparse_batch(boards, pis, king_positions)
 
-    def stringRepresentation(self, board):
+    def stringRepresentation(self, board, player=Player.black):
         """
         Input:
             board: current board
+            player: player to move
 
         Returns:
-            boardString: a quick conversion of board to a string format.
-                         Required by MCTS for hashing.
+            boardString: the 64-bit Zobrist key of the board state (including
+                         the repetition count and the player to move).
+                         Required by MCTS for hashing. Use board.bytes() if
+                         the full board needs to be serialized.
         """
-        return board.bytes()
-        # return str(board)
+        return board.search_key(player)
 
 
+# see tafl/ActionCodec.py
 def action_conversion__explicit_to_index(explicit, size):
-    (x_from, y_from), (x_to, y_to) = explicit
-    movement_type = MovementType.horizontal if y_from == y_to else MovementType.vertical
-    to = x_to if movement_type == MovementType.horizontal else y_to
-    result = (((x_from - 1) * size + y_from - 1) * size + to - 1) * 2 + movement_type   # all coordinates -1 because of the border
-    assert 0 <= result < size*size*size * 2
-    return result
+    return get_action_codec(size).encode(explicit)
 
 
 def action_conversion__index_to_explicit(action, size):
-    from_x, from_y, to, movement_type = np.unravel_index(action, (size, size, size, 2))
-    if movement_type == MovementType.horizontal:
-        action = ((from_x + 1, from_y + 1), (to + 1, from_y + 1))  # all coordinates + 1 because of the border
-    else:
-        action = ((from_x + 1, from_y + 1), (from_x + 1, to + 1))  # all coordinates + 1 because of the border
-    return action
+    return get_action_codec(size).decode(action)
 
 
 # checks whether the next move would lead to a board state where the opponent of the turn player could make a move
@@ -404,20 +341,19 @@ def would_next_board_lead_to_third(board, move, turn_player):
 
     # if nothing is captured and the current board state has been seen two times already,
     # then the next player can just revert the currently checked move and win
-    board_bytes = board.board.tobytes()
+    board_bytes = board.state_key()
     if board_bytes in board.board_states_dict and board.board_states_dict[board_bytes] == 2:
         return True
 
     # see regular move method for a short explanation
-    board.board[move_to] = (board.board[move_to] & TileState.throne) | \
-                          (board.board[move_from] & (TileState.white | TileState.black | TileState.king))
-    board.board[move_from] = board.board[move_from] & \
-                            ~(TileState.white | TileState.black | TileState.king)  # remove piece from tile
+    board.set_tile(move_to, (previous_to & TileState.throne) |
+                   (previous_from & (TileState.white | TileState.black | TileState.king)))
+    board.set_tile(move_from, previous_from & ~(TileState.white | TileState.black | TileState.king))  # remove piece from tile
     result = False
     for action in board.get_valid_actions(-1 * turn_player):
         result = result or would_next_board_be_third(board, action)
-    board.board[move_from] = previous_from
-    board.board[move_to] = previous_to
+    board.set_tile(move_from, previous_from)
+    board.set_tile(move_to, previous_to)
     return result
 
 
@@ -452,17 +388,11 @@ def would_next_board_be_third(board, action):
             and board.board[x_to, y_to - 2] & (own_tile_state | TileState.corner | throne_check) != 0:
         return False
 
-    # see regular move method for a short explanation
-    board.board[move_to] = (board.board[move_to] & TileState.throne) | \
-                             (board.board[move_from] & (TileState.white | TileState.black | TileState.king))
-    board.board[move_from] = board.board[move_from] & \
-                                 ~(TileState.white | TileState.black | TileState.king)  # remove piece from tile
-
-    board_bytes = board.board.tobytes()
-    result = board_bytes in board.board_states_dict and board.board_states_dict[board_bytes] == 2
-    board.board[move_from] = previous_from
-    board.board[move_to] = previous_to
-    return result
+    # the Zobrist hash of the board after the move, the tiles themselves don't have to be changed for it
+    piece = previous_from & PIECES
+    (x_from, y_from) = move_from
+    board_bytes = board.state_key() ^ ZOBRIST_TILE_KEYS[piece][x_from][y_from] ^ ZOBRIST_TILE_KEYS[piece][x_to][y_to]
+    return board_bytes in board.board_states_dict and board.board_states_dict[board_bytes] == 2
 
 
 # returns a winning move for white in the sense that either the move itself or the next move wins the game for white
@@ -517,58 +447,47 @@ def get_king_escape_move(board):
             and sum(board.board[3:board.size - 1, board.size]) == TileState.empty:
         return board.king_position, (king_x, board.size)
 
-    # all the interesting moves are not dependent on the move the king makes
-    black_move_end_points = [move_to for move_from, move_to in board.get_valid_actions(Player.black)]
-
     # moves to an edge where the king can escape during the next turn and no black piece can block it despite the
     # edge not being empty
     # top -> right
     if (board.king_position, (1, king_y)) in king_moves \
             and sum(board.board[1, king_y + 1:board.size]) == TileState.empty \
-            and [to_position for to_position in black_move_end_points
-                 if to_position in [(1, y) for y in range(king_y + 1, board.size)]] == []:
+            and not any(board.can_reach(Player.black, (1, y)) for y in range(king_y + 1, board.size)):
         return board.king_position, (1, king_y)
     # top -> left
     if (board.king_position, (1, king_y)) in king_moves \
             and sum(board.board[1, king_y - 1:1]) == TileState.empty \
-            and [to_position for to_position in black_move_end_points
-                 if to_position in [(1, y) for y in range(king_y - 1, 1)]] == []:
+            and not any(board.can_reach(Player.black, (1, y)) for y in range(king_y - 1, 1)):
         return board.king_position, (1, king_y)
     # bottom -> right
     if (board.king_position, (board.size, king_y)) in king_moves \
             and sum(board.board[board.size, king_y + 1:board.size]) == TileState.empty \
-            and [to_position for to_position in black_move_end_points
-                 if to_position in [(board.size, y) for y in range(king_y + 1, board.size)]] == []:
+            and not any(board.can_reach(Player.black, (board.size, y)) for y in range(king_y + 1, board.size)):
         return board.king_position, (board.size, king_y)
     # bottom -> left
     if (board.king_position, (board.size, king_y)) in king_moves \
             and sum(board.board[board.size, king_y - 1:1]) == TileState.empty \
-            and [to_position for to_position in black_move_end_points
-                 if to_position in [(board.size, y) for y in range(king_y - 1, 1)]] == []:
+            and not any(board.can_reach(Player.black, (board.size, y)) for y in range(king_y - 1, 1)):
         return board.king_position, (board.size, king_y)
     # left -> top
     if (board.king_position, (king_x, 1)) in king_moves \
             and sum(board.board[king_x - 1:1, 1]) == TileState.empty \
-            and [to_position for to_position in black_move_end_points
-                 if to_position in [(x, 1) for x in range(king_x - 1, 1)]] == []:
+            and not any(board.can_reach(Player.black, (x, 1)) for x in range(king_x - 1, 1)):
         return board.king_position, (king_x, 1)
     # left -> bottom
     if (board.king_position, (king_x, 1)) in king_moves \
             and sum(board.board[king_x + 1:board.size, 1]) == TileState.empty \
-            and [to_position for to_position in black_move_end_points
-                 if to_position in [(x, 1) for x in range(king_x + 1, board.size)]] == []:
+            and not any(board.can_reach(Player.black, (x, 1)) for x in range(king_x + 1, board.size)):
         return board.king_position, (king_x, 1)
     # right -> top
     if (board.king_position, (king_x, board.size)) in king_moves \
             and sum(board.board[king_x - 1:1, board.size]) == TileState.empty \
-            and [to_position for to_position in black_move_end_points
-                 if to_position in [(x, board.size) for x in range(king_x - 1, 1)]] == []:
+            and not any(board.can_reach(Player.black, (x, board.size)) for x in range(king_x - 1, 1)):
         return board.king_position, (king_x, board.size)
     # right -> bottom
     if (board.king_position, (king_x, board.size)) in king_moves \
             and sum(board.board[king_x + 1:board.size, board.size]) == TileState.empty \
-            and [to_position for to_position in black_move_end_points
-                 if to_position in [(x, board.size) for x in range(king_x + 1, board.size)]] == []:
+            and not any(board.can_reach(Player.black, (x, board.size)) for x in range(king_x + 1, board.size)):
         return board.king_position, (king_x, board.size)
 
     # moves to (2,2) and their symmetries, if there is no piece on (2,1) and (1,2) and no black piece that can
@@ -602,8 +521,7 @@ def get_king_escape_move(board):
 
 
 # returns a move that captures the king if possible, else returns None
-# valid_actions is passed as an arguments so that it doesn't need to be calculated again
-def get_king_capture_move(board, valid_actions):
+def get_king_capture_move(board):
     king_x, king_y = board.king_position
     king_capture_positions = []
 
@@ -627,64 +545,22 @@ def get_king_capture_move(board, valid_actions):
         elif board.board[king_x, king_y - 1] == TileState.black and board.board[king_x, king_y + 1] == TileState.empty:
             king_capture_positions.append((king_x, king_y + 1))
 
-    if not king_capture_positions:
-        for action in valid_actions:
-            if action[1] in king_capture_positions:
-                return action
+    # the moves are looked up in the reach map of black, the first one in the order of the move generation is taken
+    capture_moves = [move for position in king_capture_positions for move in board.moves_to(Player.black, position)]
+    if capture_moves:
+        return min(capture_moves)
     return None
 
 
 # checks whether the next board after the given move would lead to a board where the opponent of the turn player
-# could win the game
+# could win the game. getValidMoves uses the faster tafl/TacticalOracle.py that gives the same results
 def would_next_board_lead_to_opponent_winning(board, move, turn_player):
-    move_from, move_to = move
-    x, y = move_to
-    previous_from = board.board[move_from]
-    previous_to = board.board[x, y]
-
-    # see regular move method for a short explanation
-    board.board[move_to] = (board.board[move_to] & TileState.throne) | \
-                           (board.board[move_from] & (TileState.white | TileState.black | TileState.king))
-    board.board[move_from] = board.board[move_from] & \
-                             ~(TileState.white | TileState.black | TileState.king)  # remove piece from tile
-
-    captured_pieces = []
-    own_tile_state = TileState.white | TileState.king if turn_player == Player.white else TileState.black
-    # TileState.white for Player.black, TileState.black for Player.white
-    # this way is necessary because capturing the king works differently and is done further below
-    opponent_pawn_tile_state = TileState.black if turn_player == Player.black else TileState.white
-
-    throne_check = TileState.empty if board.board[board.king_position] & TileState.throne != 0 else TileState.throne
-    # check capture bottom
-    if board.board[x + 1, y] & opponent_pawn_tile_state != 0 \
-            and board.board[x + 2, y] & (own_tile_state | TileState.corner | throne_check) != 0:
-        board.board[x + 1, y] = TileState.empty
-        captured_pieces.append((x + 1, y))
-
-    # check capture top
-    if board.board[x - 1, y] & opponent_pawn_tile_state != 0 \
-            and board.board[x - 2, y] & (own_tile_state | TileState.corner | throne_check) != 0:
-        board.board[x - 1, y] = TileState.empty
-        captured_pieces.append((x - 1, y))
-
-    # check capture right
-    if board.board[x, y + 1] & opponent_pawn_tile_state != 0 \
-            and board.board[x, y + 2] & (own_tile_state | TileState.corner | throne_check) != 0:
-        board.board[x, y + 1] = TileState.empty
-        captured_pieces.append((x, y + 1))
-
-    # check capture left
-    if board.board[x, y - 1] & opponent_pawn_tile_state != 0 \
-            and board.board[x, y - 2] & (own_tile_state | TileState.corner | throne_check) != 0:
-        board.board[x, y - 1] = TileState.empty
-        captured_pieces.append((x, y - 1))
-
-    if turn_player == Player.black:
-        result = get_king_capture_move(board, board.get_valid_actions(Player.black)) is None
+    board.push(move, turn_player)
+    if board.outcome != Outcome.ongoing:
+        result = board.outcome == (Outcome.white if turn_player == Player.black else Outcome.black)
+    elif turn_player == Player.black:
+        result = get_king_escape_move(board) is not None
     else:
-        result = get_king_escape_move(board) is None
-    for position in captured_pieces:
-        board.board[position] = opponent_pawn_tile_state
-    board.board[move_from] = previous_from
-    board.board[move_to] = previous_to
+        result = get_king_capture_move(board) is not None
+    board.pop()
     return result
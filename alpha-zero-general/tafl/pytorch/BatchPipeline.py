@@ -0,0 +1,119 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+
+class ReplayBatches(Dataset):
+    """
+    Dataset view of a ReplayBuffer for a torch DataLoader. The items are whole
+    batches: the sampler yields (indices, symmetries, weights) of the
+    examples, which are gathered with one ReplayBuffer.batch call.
+    """
+
+    def __init__(self, examples):
+        self.examples = examples
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, sample):
+        return batch_tensors(self.examples, sample)
+
+
+def batch_tensors(examples, sample, pin_memory=False):
+    """
+    Input:
+        sample: (indices, symmetries, weights), see BatchPipeline.sample_ids
+
+    Returns:
+        (boards, target_pis, target_vs, scalar_values, weights): the examples
+            at indices and their loss weights (None for equal weights) as cpu
+            tensors. The boards stay uint8, they are converted to float on the
+            device they are used on.
+    """
+    indices, symmetries, weights = sample
+    arrays = examples.batch(indices, symmetries) + ((weights,) if weights is not None else ())
+    tensors = tuple(torch.from_numpy(array) for array in arrays)
+    if pin_memory:
+        tensors = tuple(tensor.pin_memory() for tensor in tensors)
+    return tensors if weights is not None else tensors + (None,)
+
+
+class BatchPipeline():
+    """
+    Iterates over num_batches training batches of a ReplayBuffer, drawn by a
+    HistorySampler (see ReplayBuffer.py), while the next batches are already
+    gathered:
+
+        workers = 0: every batch is gathered when it is requested
+        workers > 0 and not use_dataloader: a pool of worker threads gathers
+                    up to prefetch batches ahead (numpy releases the GIL while
+                    copying from the memory-mapped columns)
+        use_dataloader: a torch DataLoader with workers worker processes
+
+    The batches are moved to the gpu with cuda set. Every batch comes with the
+    global indices of its examples, so that the losses can be passed back to
+    the sampler (see PrioritizedReplay.py). The samples are drawn ahead of the
+    training by up to prefetch batches (by the DataLoader's own prefetching),
+    so new priorities only affect the batches drawn after them.
+    """
+
+    def __init__(self, sampler, batch_size, num_batches, workers=1, prefetch=4, use_dataloader=False, cuda=False):
+        self.sampler = sampler
+        self.examples = sampler.buffer
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.workers = workers
+        self.prefetch = max(prefetch, 1)
+        self.use_dataloader = use_dataloader
+        self.cuda = cuda
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        self.samples = collections.deque()
+        if self.use_dataloader:
+            batches = self.loader_batches()
+        elif self.workers > 0:
+            batches = self.prefetched_batches()
+        else:
+            batches = (batch_tensors(self.examples, sample) for sample in self.sample_ids())
+        # a batch is gathered after its sample was drawn
+        for tensors, (indices, _, _) in zip(batches, self.drawn_samples()):
+            if self.cuda:
+                tensors = [tensor.cuda(non_blocking=True) if tensor is not None else None for tensor in tensors]
+            boards, target_pis, target_vs, scalar_values, weights = tensors
+            yield boards.float(), target_pis, target_vs, scalar_values.float(), indices, weights
+
+    def sample_ids(self):
+        # drawn in the main thread, so the batches only depend on the numpy seed. The symmetries are only drawn if the
+        # buffer holds canonical examples
+        for _ in range(self.num_batches):
+            indices = self.sampler.sample(self.batch_size)
+            sample = indices, self.sampler.sample_symmetries(self.batch_size), self.sampler.importance_weights(indices)
+            self.samples.append(sample)
+            yield sample
+
+    def drawn_samples(self):
+        # the samples in the order of the batches, they are drawn before their batches are gathered
+        for _ in range(self.num_batches):
+            yield self.samples.popleft()
+
+    def prefetched_batches(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+            for sample in self.sample_ids():
+                pending.append(executor.submit(batch_tensors, self.examples, sample, self.cuda))
+                if len(pending) > self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def loader_batches(self):
+        # batch_size=None: the samples are passed to ReplayBatches as they are. The sampler is a generator, so the
+        # samples are drawn as the loader requests them
+        return iter(DataLoader(ReplayBatches(self.examples), sampler=self.sample_ids(), batch_size=None,
+                               num_workers=self.workers, pin_memory=self.cuda))
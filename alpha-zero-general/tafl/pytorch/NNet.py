@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import os
 import shutil
 import time
@@ -6,6 +7,7 @@ import numpy as np
 import sys
 
 from NeuralNet import NeuralNet
+from ReplayBuffer import HistorySampler, ReplayBuffer
 from pytorch_classification.utils import AverageMeter
 from pytorch_classification.utils.progress.progress.bar import Bar
 from utils import dotdict
@@ -18,8 +20,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torchvision import datasets, transforms
-from torch.autograd import Variable
 
+from .BatchPipeline import BatchPipeline
 from .TaflNNet import TaflNNet as tnnet
 
 args = dotdict({
@@ -29,6 +31,9 @@ args = dotdict({
     'batch_size': 64,
     'cuda': torch.cuda.is_available(),
     'num_channels': 512,
+    'data_workers': 1,          # threads that gather the next training batches (0: gather them in the training loop)
+    'prefetch_batches': 4,      # number of batches gathered ahead
+    'use_dataloader': False,    # gather the batches with a torch DataLoader and data_workers processes instead
     'num_scalar_values': 2,  # ## bei Änderung der Anzahl der eingegebenen skalaren Werte:
     #                               1. Hier die richtige Anzahl eintragen
     #                               2. Bei TaflGame.getSymmetries(...) Methode die zusätzlichen Werte ins letzte Tupel eintragen
@@ -39,56 +44,74 @@ args = dotdict({
 })
 
 class NNetWrapper(NeuralNet):
+    # versions are unique over all instances, so that cached evaluations of different nets never collide
+    versions = itertools.count()
+
     def __init__(self, game):
+        self.game = game
         self.nnet = tnnet(game, args)
+        self.version = next(NNetWrapper.versions)    # changes whenever the weights change
         self.board_x, self.board_y = game.getBoardSize()
         self.action_size = game.getActionSize()
+        # nnet.eval() is only called again by predict_batch after train() switched the net to training mode
+        self.eval_mode = False
+        self.board_buffer = None
+        self.scalar_buffer = None
+        self.cuda = args.cuda
 
-        if args.cuda:
+        if self.cuda:
             self.nnet.cuda()
 
     def train(self, examples):
         """
-        examples: list of examples, each example is of form (board, pi, v)
+        examples: HistorySampler (or PrioritizedSampler), ReplayBuffer or list
+                  of examples, each example is of form
+                  (board, pi, v, scalar_values)
         """
+        if not isinstance(examples, (HistorySampler, ReplayBuffer)):
+            examples = ReplayBuffer.from_examples(examples, (self.board_x, self.board_y), self.action_size,
+                                                  args.num_scalar_values)
+        if isinstance(examples, ReplayBuffer):
+            examples = HistorySampler(examples)
         optimizer = optim.Adam(self.nnet.parameters())
+        self.version = next(NNetWrapper.versions)
 
         for epoch in range(args.epochs):
             print('EPOCH ::: ' + str(epoch+1))
             self.nnet.train()
+            self.eval_mode = False
             data_time = AverageMeter()
+            compute_time = AverageMeter()
             batch_time = AverageMeter()
             pi_losses = AverageMeter()
             v_losses = AverageMeter()
-            end = time.time()
 
-            bar = Bar('Training Net', max=int(len(examples)/args.batch_size))
+            num_batches = int(len(examples)/args.batch_size)
+            bar = Bar('Training Net', max=num_batches)
             batch_idx = 0
 
-            while batch_idx < int(len(examples)/args.batch_size):
-                sample_ids = np.random.randint(len(examples), size=args.batch_size)
-                boards, pis, vs, scalar_values = list(zip(*[examples[i] for i in sample_ids]))
-                boards = torch.FloatTensor(np.array(boards).astype(np.float64))
-                scalar_values = torch.FloatTensor(np.array(scalar_values).astype(np.float64))
-                target_pis = torch.FloatTensor(np.array(pis))
-                target_vs = torch.FloatTensor(np.array(vs).astype(np.float64))
-
-                # predict
-                if args.cuda:
-                    boards, target_pis, target_vs, scalar_values \
-                        = boards.contiguous().cuda(), target_pis.contiguous().cuda(),target_vs.contiguous().cuda(),\
-                          scalar_values.contiguous().cuda()
-                boards, target_pis, target_vs, scalar_values \
-                    = Variable(boards), Variable(target_pis), Variable(target_vs), Variable(scalar_values)
-
-                # measure data loading time
+            # the batches are gathered (and prefetched) by the pipeline, see tafl/pytorch/BatchPipeline.py
+            batches = iter(BatchPipeline(examples, args.batch_size, num_batches, args.data_workers,
+                                         args.prefetch_batches, args.use_dataloader, self.cuda))
+            end = time.time()
+            while batch_idx < num_batches:
+                boards, target_pis, target_vs, scalar_values, sample_ids, weights = next(batches)
+
+                # measure data loading time (the time the training waits for the next batch)
                 data_time.update(time.time() - end)
+                compute_start = time.time()
 
                 # compute output
                 out_pi, out_v = self.nnet(boards, scalar_values)
-                l_pi = self.loss_pi(target_pis, out_pi)
-                l_v = self.loss_v(target_vs, out_v)
-                total_loss = l_pi + l_v
+                example_losses_pi = self.example_losses_pi(target_pis, out_pi)
+                example_losses_v = self.example_losses_v(target_vs, out_v)
+                l_pi = example_losses_pi.mean()
+                l_v = example_losses_v.mean()
+                if weights is None:
+                    total_loss = l_pi + l_v
+                else:
+                    # the importance weights of a prioritized sampler
+                    total_loss = torch.mean(weights * (example_losses_pi + example_losses_v))
 
                 # record loss
                 pi_losses.update(l_pi.data.item(), boards.size(0))
@@ -99,16 +122,21 @@ class NNetWrapper(NeuralNet):
                 total_loss.backward()
                 optimizer.step()
 
+                # the losses are the priorities of a prioritized sampler
+                examples.update_priorities(sample_ids, (example_losses_pi + example_losses_v).detach().cpu().numpy())
+
                 # measure elapsed time
+                compute_time.update(time.time() - compute_start)
                 batch_time.update(time.time() - end)
                 end = time.time()
                 batch_idx += 1
 
                 # plot progress
-                bar.suffix  = '({batch}/{size}) Data: {data:.3f}s | Batch: {bt:.3f}s | Total: {total:} | ETA: {eta:} | Loss_pi: {lpi:.4f} | Loss_v: {lv:.3f}'.format(
+                bar.suffix  = '({batch}/{size}) Data: {data:.3f}s | Compute: {compute:.3f}s | Batch: {bt:.3f}s | Total: {total:} | ETA: {eta:} | Loss_pi: {lpi:.4f} | Loss_v: {lv:.3f}'.format(
                             batch=batch_idx,
-                            size=int(len(examples)/args.batch_size),
+                            size=num_batches,
                             data=data_time.avg,
+                            compute=compute_time.avg,
                             bt=batch_time.avg,
                             total=bar.elapsed_td,
                             eta=bar.eta_td,
@@ -117,39 +145,107 @@ class NNetWrapper(NeuralNet):
                             )
                 bar.next()
             bar.finish()
+            if batch_time.sum > 0:
+                print('data loading: {:.2f}s, compute: {:.2f}s ({:.1f}% of the time waiting for data)'.format(
+                    data_time.sum, compute_time.sum, 100 * data_time.sum / batch_time.sum))
 
 
     def predict(self, board, scalar_values):
         """
         board: np array with board
         """
+        pis, vs = self.predict_batch([board], [scalar_values])
+        return pis[0], vs[0]
+
+    def predict_batch(self, boards, scalar_values):
+        """
+        boards: stacked uint8 array of shape (n, board_x, board_y) or list of
+                boards (TaflBoard / TaflBitBoard or np arrays without the border)
+        scalar_values: array of shape (n, num_scalar_values) or list of np arrays
+
+        Returns the policies (n, action_size) and values (n, 1) of all boards
+        from one forward pass.
+        """
         # timing
         start = time.time()
 
         # preparing input
-        board = torch.FloatTensor(board.board[1: self.board_x + 1, 1: self.board_y + 1].astype(np.float64))
-        scalar_values = torch.FloatTensor(scalar_values)
-        if args.cuda:
-            board = board.contiguous().cuda()
-            scalar_values = scalar_values.contiguous().cuda()
-        with torch.no_grad():
-            board = Variable(board)
-            board = board.view(1, self.board_x, self.board_y)
-            scalar_values = Variable(scalar_values)
-            scalar_values = scalar_values.view(1, -1)
-            # print(board)
-            # print(player)
+        boards = self.stack_boards(boards)
+        scalar_values = np.asarray(scalar_values).reshape(len(boards), -1)
+        n = len(boards)
+        if self.board_buffer is None or self.board_buffer.size(0) < n:
+            self.allocate_buffers(max(n, 2 * (0 if self.board_buffer is None else self.board_buffer.size(0))))
+        # the copies convert to float (and move to the gpu) without temporary float64 arrays
+        board_input = self.board_buffer[:n]
+        board_input.copy_(torch.from_numpy(boards))
+        scalar_input = self.scalar_buffer[:n]
+        scalar_input.copy_(torch.from_numpy(scalar_values))
+
+        if not self.eval_mode:
             self.nnet.eval()
-            pi, v = self.nnet(board, scalar_values)
+            self.eval_mode = True
+        with torch.inference_mode():
+            pi, v = self.nnet(board_input, scalar_input)
 
         #print('PREDICTION TIME TAKEN : {0:03f}'.format(time.time()-start))
-        return torch.exp(pi).data.cpu().numpy()[0], v.data.cpu().numpy()[0]
+        return torch.exp(pi).cpu().numpy(), v.cpu().numpy()
+
+    def stack_boards(self, boards):
+        """
+        Returns the interiors of boards as one contiguous uint8 array.
+        """
+        if isinstance(boards, np.ndarray):
+            return np.ascontiguousarray(boards, dtype=np.uint8)
+        stacked = np.empty((len(boards), self.board_x, self.board_y), dtype=np.uint8)
+        for i, board in enumerate(boards):
+            if hasattr(board, 'board'):
+                board = board.board[1: self.board_x + 1, 1: self.board_y + 1]
+            stacked[i] = board
+        return stacked
+
+    def allocate_buffers(self, capacity):
+        # input tensors reused by predict_batch, grown when a larger batch arrives
+        device = 'cuda' if self.cuda else 'cpu'
+        self.board_buffer = torch.empty((capacity, self.board_x, self.board_y), dtype=torch.float32, device=device)
+        self.scalar_buffer = torch.empty((capacity, args.num_scalar_values), dtype=torch.float32, device=device)
+
+    def cpu_copy(self):
+        """
+        Returns a copy of this network on the cpu with the same weights and
+        version, e.g. for forked worker processes, which can't use CUDA.
+        """
+        nnet = self.__class__.__new__(self.__class__)
+        nnet.__setstate__(dict(self.__getstate__(), cuda=False))
+        return nnet
+
+    def __getstate__(self):
+        # the network is pickled as its weights on the cpu and built again when it is unpickled (e.g. in a spawned
+        # process). The args are pickled as a dict, a dotdict can't be unpickled
+        state = self.__dict__.copy()
+        state['nnet'] = {name: tensor.cpu() for name, tensor in self.nnet.state_dict().items()}
+        state['nnet_args'] = dict(self.nnet.args)
+        state['board_buffer'] = None
+        state['scalar_buffer'] = None
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        weights = state.pop('nnet')
+        nnet_args = state.pop('nnet_args')
+        self.__dict__.update(state)
+        self.nnet = tnnet(self.game, dotdict(nnet_args))
+        self.nnet.load_state_dict(weights)
+        self.eval_mode = False
+        if self.cuda:
+            self.nnet.cuda()
 
-    def loss_pi(self, targets, outputs):
-        return -torch.sum(targets*outputs)/targets.size()[0]
+    def example_losses_pi(self, targets, outputs):
+        # policy loss of every example of the batch
+        return -torch.sum(targets*outputs, dim=1)
 
-    def loss_v(self, targets, outputs):
-        return torch.sum((targets-outputs.view(-1))**2)/targets.size()[0]
+    def example_losses_v(self, targets, outputs):
+        # value loss of every example of the batch
+        return (targets-outputs.view(-1))**2
 
     def save_checkpoint(self, folder='checkpoint', filename='checkpoint.pth.tar'):
         filepath = os.path.join(folder, filename)
@@ -169,3 +265,4 @@ class NNetWrapper(NeuralNet):
             raise Exception("No model in path {}".format(filepath))
         checkpoint = torch.load(filepath)
         self.nnet.load_state_dict(checkpoint['state_dict'])
+        self.version = next(NNetWrapper.versions)
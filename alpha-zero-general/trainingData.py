@@ -2,22 +2,28 @@ import numpy as np
 import pickle
 from collections import deque
 from tafl.TaflBoard import TaflBoard, Player, Outcome, TileState
-from tafl.TaflGame import TaflGame, MovementType, action_conversion__explicit_to_index
+from tafl.TaflGame import TaflGame
 
 
 # reads the data and removes all the games which do not clearly show a winner or are inconsistent with our rules
 def generate_training_example(game, board, action, turn_player):
     king_position = board.king_position
-    pi = np.zeros(7*7*7*2+1)
+    # sparse policy (indices, probs), the expert move has probability 1
+    pi = np.array([game.codec.encode(action)]), np.ones(1)
+    # the symmetries are added for the whole game at once, see symmetric_examples
+    return board.board[1:8, 1:8].copy(), pi, king_position
 
-    (x_from, y_from), (x_to, y_to) = action
-    movement_type = MovementType.horizontal if y_from == y_to else MovementType.vertical
-    to = x_to if movement_type == MovementType.horizontal else y_to
-    index = (((x_from - 1) * 7 + y_from - 1) * 7 + to - 1) * 2 + movement_type  # all coordinates -1 because of the border
-    assert 0 <= index < 7 * 7 * 7 * 2
 
-    pi[index] = 1
-    return game.getSymmetries(board, pi, king_position)
+# returns [board, pi, king_position] for all symmetrical forms of the examples (see TaflGame.getSymmetries), or the
+# examples themselves if the replay buffers apply the symmetries (args.store_symmetries)
+def symmetric_examples(game, examples, store_symmetries=True):
+    if not store_symmetries:
+        return [list(example) for example in examples]
+    if not examples:
+        return []
+    boards, pis, king_positions = zip(*examples)
+    boards, pis, king_positions = game.getSparseSymmetriesBatch(np.array(boards), pis, np.array(king_positions))
+    return [[boards[i], pis[i], tuple(king_positions[i].tolist())] for i in range(len(boards))]
 
 
 def read_data(args):
@@ -106,6 +112,8 @@ def read_data(args):
         board = TaflBoard(7)
         board.print_game_over_reason = False
         turn_player = Player.black
+        game_examples_white = []
+        game_examples_black = []
         for string in games[i]:
             try:
                 action = ((move_conversion_table[string[0]], move_conversion_table[string[1]]),
@@ -117,15 +125,17 @@ def read_data(args):
             # print(str(action) + "  " + string)
             assert board.outcome == Outcome.ongoing, str(i)
 
-            symmetries = generate_training_example(game, board, action, turn_player)
-            player_train_examples = trainExamples_white if turn_player == Player.white else trainExamples_black
-            for b, p, scalar_values in symmetries:
-                player_train_examples.append([b, p, scalar_values])
+            example = generate_training_example(game, board, action, turn_player)
+            game_examples = game_examples_white if turn_player == Player.white else game_examples_black
+            game_examples.append(example)
 
             board.do_action(action, turn_player)
             # print(board)
             turn_player *= -1
 
+        trainExamples_white.extend(symmetric_examples(game, game_examples_white, args.store_symmetries))
+        trainExamples_black.extend(symmetric_examples(game, game_examples_black, args.store_symmetries))
+
         assert outcome_conversion_table[outcomes[i]] == board.outcome, "\n" + str(board) + "\nexpected: " \
                                    + str(board.outcome) + ", actual: " + str(outcome_conversion_table[outcomes[i]]) \
                                    + "\n" + king_capture_check(board) + "\n example number:" + str(i)